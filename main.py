@@ -1,14 +1,15 @@
 import sys
-from src.cli import run_cli
-import flet as ft
-from src.ui import main as ui_main
 
 def main():
-    # Si hay argumentos (más allá del nombre del script), usamos CLI
+    # Si hay argumentos (más allá del nombre del script), usamos CLI.
+    # Cada modo importa solo lo suyo: el CLI no carga flet ni la interfaz.
     if len(sys.argv) > 1:
+        from src.cli import run_cli
         run_cli()
     else:
         print("Iniciando modo gráfico...")
+        import flet as ft
+        from src.ui import main as ui_main
         ft.app(target=ui_main)
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+"""
+Benchmark de arranque: mide cuánto cuesta importar el camino de cada modo
+(CLI, GUI y bot) y comprueba que no se carguen dependencias pesadas que ese
+modo no usa al arrancar.
+
+Uso:
+    python scripts/bench_startup.py [--runs 5] [--max-ms 800]
+
+Cada medición se hace en un intérprete nuevo (sin caché de módulos) y se
+reporta la mejor de `--runs`. Sale con código 1 si algún modo carga una
+dependencia prohibida o supera `--max-ms`.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Dependencias pesadas que se vigilan
+HEAVY = ['yt_dlp', 'flet', 'telethon', 'speedtest', 'telegram']
+
+# modo: (código que reproduce el arranque, dependencias que NO debe cargar)
+MODES = {
+    'cli': ("import main; from src.cli import run_cli",
+            ['yt_dlp', 'flet', 'telethon', 'speedtest', 'telegram']),
+    'gui': ("import main; import flet; from src.ui import main",
+            ['yt_dlp', 'telethon', 'speedtest', 'telegram']),
+    # telethon lo carga post_init al conectar el userbot, no el import del módulo
+    'bot': ("import src.bot",
+            ['yt_dlp', 'flet', 'telethon', 'speedtest']),
+}
+
+CHILD = """
+import json, sys, time
+t = time.perf_counter()
+{code}
+ms = (time.perf_counter() - t) * 1000
+print(json.dumps({{'ms': ms, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def measure(code, workdir):
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1',
+               # El bot sale si faltan credenciales; con estas arranca sin conectarse
+               TELEGRAM_TOKEN=os.environ.get('TELEGRAM_TOKEN', '0:bench'),
+               ALLOWED_USER_ID=os.environ.get('ALLOWED_USER_ID', '1'))
+    proc = subprocess.run([sys.executable, '-c', CHILD.format(code=code, heavy=HEAVY)],
+                          cwd=workdir, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        last = (proc.stderr.strip().splitlines() or ['?'])[-1]
+        return None, last
+    return json.loads(proc.stdout.strip().splitlines()[-1]), None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque de TubeGo")
+    parser.add_argument("--runs", type=int, default=5, help="Mediciones por modo (se reporta la mejor)")
+    parser.add_argument("--max-ms", type=float, default=None, help="Falla si algún modo tarda más")
+    parser.add_argument("modes", nargs='*', help=f"Modos a medir: {', '.join(MODES)} (default: todos)")
+    args = parser.parse_args()
+    unknown = [m for m in args.modes if m not in MODES]
+    if unknown:
+        parser.error(f"modo desconocido: {', '.join(unknown)}")
+
+    failed = False
+    # Directorio temporal: el bot y el Downloader crean data/, logs/ y downloads/
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes or MODES:
+            code, forbidden = MODES[mode]
+            best, error = None, None
+            for _ in range(args.runs):
+                result, error = measure(code, workdir)
+                if result is None: break
+                if best is None or result['ms'] < best['ms']: best = result
+
+            if best is None:
+                print(f"{mode:4}  no disponible ({error})")
+                continue
+
+            leaked = [m for m in best['loaded'] if m in forbidden]
+            line = f"{mode:4}  {best['ms']:8.1f} ms  carga: {', '.join(best['loaded']) or '-'}"
+            if leaked:
+                line += f"  << no debería cargar: {', '.join(leaked)}"
+                failed = True
+            if args.max_ms is not None and best['ms'] > args.max_ms:
+                line += f"  << supera {args.max_ms:.0f} ms"
+                failed = True
+            print(line)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
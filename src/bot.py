@@ -4,17 +4,21 @@ import subprocess
 import logging
 import asyncio
 import traceback
+import random
+import time
+import copy
 import concurrent.futures
-import speedtest
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from telegram import Update, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.request import HTTPXRequest
+from telegram.error import RetryAfter, BadRequest
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, filters
 from src.manager import DownloadManager
+from src.core import info_cache, is_playlist_url, GrowingFile, progress_bus, ydl_pool
 
-# --- TELETHON (Userbot for large files) ---
-from telethon import TelegramClient
-from telethon.tl.types import DocumentAttributeVideo
+# Telethon (userbot for large files) and speedtest are imported where they are
+# used, so a bot restart doesn't pay for loading them.
 
 # Load environment variables
 load_dotenv()
@@ -40,13 +44,29 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Global Instances
-manager = DownloadManager()
-download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
-FILE_CACHE = []
+# DISK_QUOTA_MB: budget for downloads/ + uploaded/; already uploaded files are evicted LRU-first (0 = only keep free space)
+manager = DownloadManager(disk_budget=int(os.getenv("DISK_QUOTA_MB", "0")) * 1024 * 1024)
+download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4) # Link analysis; downloads go through manager.scheduler
 
 # Global Configuration
 # 'ask', 'max', '1080', '720', '480', 'audio'
 DEFAULT_QUALITY = 'ask' 
+BATCH_PARALLEL = 2 # Playlist entries downloaded at the same time
+PIPE_THROUGH = False # Upload via userbot while downloading (single-stream formats)
+PIPE_START_TIMEOUT = 600 # Seconds a piped download may take to start writing before it's uploaded normally
+STREAM_PART_SIZE = 512 * 1024 # MTProto part size for streamed uploads
+EDIT_CHAT_INTERVAL = 3.0 # Min seconds between live progress edits in one chat
+EDIT_GLOBAL_RATE = 20 # Max live progress edits per second across all chats
+USERBOT_CONCURRENCY = 2 # Userbot uploads running at the same time on the shared client
+USERBOT_HEALTH_INTERVAL = 60 # Seconds between userbot connection checks
+USERBOT_CONNECTIONS = int(os.getenv("USERBOT_CONNECTIONS", "4")) # Parallel MTProto senders per userbot upload
+UPLOAD_PART_SIZE = 512 * 1024 # MTProto part size (maximum allowed)
+BOT_API_UPLOAD_LIMIT = 50 * 1024 * 1024 # Bigger files go through the userbot
+PRE_UPLOAD_HASH_LIMIT = 200 * 1024 * 1024 # Files up to this size are hashed before uploading, to find an earlier copy
+UPLOAD_LANE_LIMITS = {'bot': 3, 'mtproto': 1} # Concurrent uploads per lane
+FILES_PER_PAGE = 8 # Files per /files page (message and keyboard stay within Telegram's limits)
+SEGMENT_MAX_BYTES = int(os.getenv("SEGMENT_MAX_MB", "1950")) * 1024 * 1024 # Bigger files are split (MTProto limit is 2GB)
+SEGMENT_MAX_SECONDS = int(os.getenv("SEGMENT_MAX_SECONDS", "0")) # Also split anything longer than this (0 = off)
 CURRENT_LANG = 'en' # Default fallback
 SESSION_PATH = os.path.join('data', 'user_session')
 
@@ -63,9 +83,17 @@ STRINGS = {
         'help': "📚 **Help Guide**\n\n1. **Downloads:** Send any link.\n2. **Smart Uploads:**\n   - Files < 50MB: Fast upload via Bot.\n   - Files > 50MB: Uploaded via Userbot (up to 2GB).\n3. **Management:** Use `/files` to check disk.",
         'status_empty': "📭 No active downloads.",
         'status_header': "📊 **Current Status:**\n",
+        'cache_stats': "🗂 Info cache: {} hits / {} misses ({} entries)",
+        'history_stats': "🗃 Task history: {} tasks",
+        'memory_stats': "🧠 In memory: {} tasks · {:.1f} KB (~{} B/task)",
+        'queue_stats': "🚦 Queue: {}/{} waiting · {}/{} running",
+        'disk_stats': "💾 Disk: {:.0f} MB used (quota {}) · {:.0f} MB free · {} evicted",
+        'queue_full': "🚦 **Download queue is full.**\nTry again later.",
         'clean_done': "🧹 Memory cleaned.",
         'files_empty': "📂 No pending files on disk.",
         'files_header': "📂 **Files on Disk (Pending):**\nSelect one to manage:\n\n",
+        'files_page': "\nPage {}/{} · {} files",
+        'sort_name': "🔤 Name", 'sort_size': "📏 Size", 'sort_date': "🕒 Date",
         'speedtest_start': "🚀 **Starting Speedtest...**\nFinding best server (~30s)...",
         'speedtest_error': "❌ Speedtest failed: {}",
         'update_check': "📡 **Checking for updates...**",
@@ -78,10 +106,29 @@ STRINGS = {
         'upload_bot': "📤 **Uploading (Bot API)...**\n`{}` ({:.1f} MB)",
         'upload_success': "✅ **Upload Complete**\n`{}`\n(Archived in 'uploaded')",
         'upload_userbot_success': "✅ **Upload Complete**\nFile uploaded via Userbot.\n(Archived)",
+        'upload_cached': "⚡ **Re-sent instantly**\n`{}`\n(Already on Telegram, no upload needed)",
+        'segment_start': "✂️ **Splitting into parts**\n`{}` ({:.0f} MB)\nEach part is sent as soon as it's ready.",
+        'segment_part': "📦 **Part {}**\n`{}`",
+        'segment_done': "✅ **Sent in {} parts**\n`{}`\n(Archived in 'uploaded')",
+        'segment_error': "❌ Split stopped after {} parts: {}",
+        'upload_speed': "⚡ {:.1f} MB in {:.0f}s ({:.1f} MB/s, {} connections)",
         'upload_error': "❌ Upload Error: {}...\nTry again.",
         'downloading': "⬇️ **Downloading ({}) ...**\nTask `{}`",
         'analyzing': "🔍 **Analyzing link...**",
         'quality_select': "📹 **{}**\n⏱ Duration: {}\n\n👇 **Select Quality:**",
+        'playlist_select': "📃 **Playlist / Channel**\n\n👇 **Select Quality:**",
+        'batch_downloading': "📃 **Downloading playlist ({}) ...**\nTask `{}` | {} parallel",
+        'batch_done': "📃 **Playlist finished:** {} of {} downloaded.",
+        'pipe_downloading': "🚰 **Downloading + uploading ({}) ...**\nTask `{}`",
+        'pipe_set': "🚰 Pipe-through uploads: **{}**",
+        'pipe_unavailable': "⚠️ Pipe-through needs API_ID/API_HASH (userbot).",
+        'resuming': "♻️ **Resuming task** `{}`\n({:.1f} MB already on disk)",
+        'progress_line': "`{}` {}\n⚡ {} · ⏳ {}",
+        'progress_processing': "⚙️ Processing...",
+        'bw_status': "📶 **Bandwidth**\n⬇️ Down: {}\n⬆️ Up: {}\n\nUsage:\n`/bw down 20` · `/bw up 5` (Mbit/s, 0 = unlimited)\n`/bw prio <task> low|normal|high`",
+        'bw_set': "✅ {} budget: **{}**",
+        'bw_prio_set': "✅ Task `{}` priority: **{}**",
+        'bw_unlimited': "unlimited",
         'invalid_link': "⚠️ Invalid link.",
         'task_init': "⏳ Starting `{}`...",
         'error_generic': "❌ Error: {}",
@@ -91,6 +138,9 @@ STRINGS = {
         'log_header': "📋 Error Log:\n{}",
         'retry_dl': "🔄 Retrying Download...",
         'retry_ul': "📤 Retrying Upload...",
+        'upload_queued': "📤 **Upload queued** ({} lane, #{})\n`{}`",
+        'upload_cancelled': "🛑 Upload cancelled. The file is still on disk.",
+        'upload_lanes': "📤 Uploads: Bot API {}/{} running, {} queued · MTProto {}/{} running, {} queued",
         'file_not_found': "❌ File not found.",
         'confirm_clean_ul': "⚠️ **Are you sure?**\nThis will permanently delete ALL files in the `uploaded` folder.",
         'clean_ul_success': "🗑️ **Cleanup Complete.** Deleted `{}` files.",
@@ -116,9 +166,17 @@ STRINGS = {
         'help': "📚 **Guía de Ayuda**\n\n1. **Descargas:** Envía cualquier enlace.\n2. **Subidas Inteligentes:**\n   - Archivos < 50MB: Subida rápida vía Bot.\n   - Archivos > 50MB: Subida vía Userbot (hasta 2GB).\n3. **Gestión:** Usa `/files` para revisar el disco.",
         'status_empty': "📭 No hay descargas activas.",
         'status_header': "📊 **Estado Actual:**\n",
+        'cache_stats': "🗂 Cache de info: {} aciertos / {} fallos ({} entradas)",
+        'history_stats': "🗃 Historial: {} tareas",
+        'memory_stats': "🧠 En memoria: {} tareas · {:.1f} KB (~{} B/tarea)",
+        'queue_stats': "🚦 Cola: {}/{} esperando · {}/{} en curso",
+        'disk_stats': "💾 Disco: {:.0f} MB en uso (cuota {}) · {:.0f} MB libres · {} desalojados",
+        'queue_full': "🚦 **La cola de descargas está llena.**\nInténtalo más tarde.",
         'clean_done': "🧹 Memoria limpiada.",
         'files_empty': "📂 No hay archivos pendientes en disco.",
         'files_header': "📂 **Archivos en Disco (Pendientes):**\nSelecciona uno para gestionar:\n\n",
+        'files_page': "\nPágina {}/{} · {} archivos",
+        'sort_name': "🔤 Nombre", 'sort_size': "📏 Tamaño", 'sort_date': "🕒 Fecha",
         'speedtest_start': "🚀 **Iniciando Speedtest...**\nBuscando mejor servidor (~30s)...",
         'speedtest_error': "❌ Falló el test: {}",
         'update_check': "📡 **Buscando actualizaciones...**",
@@ -131,10 +189,29 @@ STRINGS = {
         'upload_bot': "📤 **Subiendo (Bot API)...**\n`{}` ({:.1f} MB)",
         'upload_success': "✅ **Subida Completada**\n`{}`\n(Archivado en 'uploaded')",
         'upload_userbot_success': "✅ **Subida Completada**\nArchivo subido vía Userbot.\n(Archivado)",
+        'upload_cached': "⚡ **Reenviado al instante**\n`{}`\n(Ya estaba en Telegram, sin volver a subirlo)",
+        'segment_start': "✂️ **Dividiendo en partes**\n`{}` ({:.0f} MB)\nCada parte se envía en cuanto está lista.",
+        'segment_part': "📦 **Parte {}**\n`{}`",
+        'segment_done': "✅ **Enviado en {} partes**\n`{}`\n(Archivado en 'uploaded')",
+        'segment_error': "❌ División detenida tras {} partes: {}",
+        'upload_speed': "⚡ {:.1f} MB en {:.0f}s ({:.1f} MB/s, {} conexiones)",
         'upload_error': "❌ Error al Subir: {}...\nReintenta.",
         'downloading': "⬇️ **Descargando ({}) ...**\nTarea `{}`",
         'analyzing': "🔍 **Analizando enlace...**",
         'quality_select': "📹 **{}**\n⏱ Duración: {}\n\n👇 **Selecciona Calidad:**",
+        'playlist_select': "📃 **Playlist / Canal**\n\n👇 **Selecciona Calidad:**",
+        'batch_downloading': "📃 **Descargando playlist ({}) ...**\nTarea `{}` | {} en paralelo",
+        'batch_done': "📃 **Playlist terminada:** {} de {} descargados.",
+        'pipe_downloading': "🚰 **Descargando + subiendo ({}) ...**\nTarea `{}`",
+        'pipe_set': "🚰 Subida durante la descarga: **{}**",
+        'pipe_unavailable': "⚠️ La subida durante la descarga necesita API_ID/API_HASH (userbot).",
+        'resuming': "♻️ **Reanudando tarea** `{}`\n({:.1f} MB ya en disco)",
+        'progress_line': "`{}` {}\n⚡ {} · ⏳ {}",
+        'progress_processing': "⚙️ Procesando...",
+        'bw_status': "📶 **Ancho de banda**\n⬇️ Bajada: {}\n⬆️ Subida: {}\n\nUso:\n`/bw down 20` · `/bw up 5` (Mbit/s, 0 = sin límite)\n`/bw prio <tarea> low|normal|high`",
+        'bw_set': "✅ Presupuesto de {}: **{}**",
+        'bw_prio_set': "✅ Prioridad de la tarea `{}`: **{}**",
+        'bw_unlimited': "sin límite",
         'invalid_link': "⚠️ Enlace inválido.",
         'task_init': "⏳ Iniciando `{}`...",
         'error_generic': "❌ Error: {}",
@@ -144,6 +221,9 @@ STRINGS = {
         'log_header': "📋 Log de Error:\n{}",
         'retry_dl': "🔄 Reintentando Descarga...",
         'retry_ul': "📤 Reintentando Subida...",
+        'upload_queued': "📤 **Subida en cola** (carril {}, #{})\n`{}`",
+        'upload_cancelled': "🛑 Subida cancelada. El archivo sigue en disco.",
+        'upload_lanes': "📤 Subidas: Bot API {}/{} en curso, {} en cola · MTProto {}/{} en curso, {} en cola",
         'file_not_found': "❌ Archivo no encontrado.",
         'confirm_clean_ul': "⚠️ **¿Estás seguro?**\nEsto borrará permanentemente TODOS los archivos de la carpeta `uploaded`.",
         'clean_ul_success': "🗑️ **Limpieza completada.** Se borraron `{}` archivos.",
@@ -188,7 +268,7 @@ def get_keyboard(task_id, status):
     """Generates dynamic buttons based on task status"""
     keyboard = []
     
-    if status in ['starting', 'downloading', 'processing']:
+    if status in ['queued', 'starting', 'downloading', 'processing', 'upload_queued']:
         keyboard.append([InlineKeyboardButton(T('btn_cancel'), callback_data=f"cancel_{task_id}")])
     
     elif status == 'failed_dl':
@@ -221,7 +301,10 @@ def get_quality_keyboard(task_id):
             InlineKeyboardButton("🎵 Audio MP3", callback_data=f"qual_audio_{task_id}"),
         ],
         [
+            InlineKeyboardButton("🚀 Fast (<50MB)", callback_data=f"qual_fast_{task_id}"),
             InlineKeyboardButton("🌟 Max (4K)", callback_data=f"qual_best_{task_id}"),
+        ],
+        [
             InlineKeyboardButton(T('btn_cancel'), callback_data=f"delete_{task_id}")
         ]
     ]
@@ -262,6 +345,7 @@ async def quality_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📱 720p", callback_data="setqual_720")],
         [InlineKeyboardButton("🎥 1080p", callback_data="setqual_1080")],
         [InlineKeyboardButton("🎵 Audio", callback_data="setqual_audio")],
+        [InlineKeyboardButton("🚀 Fast (<50MB)", callback_data="setqual_fast")],
     ]
     await update.message.reply_text(
         T('quality_menu', DEFAULT_QUALITY.upper()),
@@ -269,20 +353,82 @@ async def quality_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+async def pipe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Toggle pipe-through uploads"""
+    if update.effective_user.id != ALLOWED_USER_ID: return
+    global PIPE_THROUGH
+    if not (API_ID and API_HASH):
+        await update.message.reply_text(T('pipe_unavailable'))
+        return
+    PIPE_THROUGH = not PIPE_THROUGH
+    await update.message.reply_text(T('pipe_set', 'ON' if PIPE_THROUGH else 'OFF'), parse_mode='Markdown')
+
+def format_rate(rate):
+    """bytes/s -> 'x.x Mbit/s'"""
+    return f"{rate * 8 / 1e6:.1f} Mbit/s" if rate else T('bw_unlimited')
+
+async def bw_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows or changes the bandwidth budgets and task priorities"""
+    if update.effective_user.id != ALLOWED_USER_ID: return
+    args = context.args or []
+    try:
+        if len(args) == 2 and args[0] in ('down', 'up'):
+            rate = float(args[1]) * 1e6 / 8
+            manager.bandwidth.set_budget(args[0], rate)
+            await update.message.reply_text(T('bw_set', args[0], format_rate(rate)), parse_mode='Markdown')
+            return
+        if len(args) == 3 and args[0] == 'prio':
+            if manager.set_task_priority(args[1], args[2]):
+                await update.message.reply_text(T('bw_prio_set', args[1], args[2]), parse_mode='Markdown')
+            else:
+                await update.message.reply_text(T('cancel_fail'))
+            return
+    except ValueError:
+        pass
+
+    snap = manager.bandwidth.snapshot()
+    lines = []
+    for direction in ('down', 'up'):
+        info = snap[direction]
+        tasks = " ".join(f"`{k}`:{p}/{format_rate(r)}" for k, (p, r) in info['tasks'].items())
+        lines.append(f"{format_rate(info['budget'])} {tasks}".strip())
+    await update.message.reply_text(T('bw_status', *lines), parse_mode='Markdown')
+
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ALLOWED_USER_ID: return
     tasks = manager.get_active_tasks()
+    stats = info_cache.stats()
+    cache_line = T('cache_stats', stats['hits'], stats['misses'], stats['size'])
+    cache_line += "\n" + T('history_stats', manager.store.count())
+    count, size = manager.memory_stats()
+    cache_line += "\n" + T('memory_stats', count, size / 1024, size // count if count else 0)
+    queue = manager.scheduler.snapshot()
+    cache_line += "\n" + T('queue_stats', queue['queued'], queue['max_queue'], queue['running'], queue['workers'])
+    disk = manager.quota.snapshot()
+    cache_line += "\n" + T('disk_stats', disk['used'] / 1048576, f"{disk['budget'] / 1048576:.0f} MB" if disk['budget'] else "-",
+                            (disk['free'] or 0) / 1048576, disk['evicted'])
+    lanes = upload_lanes.snapshot()
+    cache_line += "\n" + T('upload_lanes', *[lanes[lane][k] for lane in ('bot', 'mtproto') for k in ('running', 'limit', 'queued')])
+    for lane in ('bot', 'mtproto'):
+        for position, task_id in enumerate(lanes[lane]['order'], 1):
+            cache_line += f"\n   📤 {task_id} ({lane}) #{position}"
     if not tasks:
-        await update.message.reply_text(T('status_empty'))
+        await update.message.reply_text(f"{T('status_empty')}\n\n{cache_line}")
         return
     msg = T('status_header')
+    frags = manager.fragment_tuner.snapshot()
     for t in tasks:
-        msg += f"🆔 `{t['id']}` | {t['status']} | {t['progress']}\n🔗 {t['url']}\n\n"
+        frag_info = f" | 🧩 x{frags[t['id']]}" if t['id'] in frags else ""
+        if t['status'] == 'queued':
+            position = manager.scheduler.position(t['id'])
+            if position: frag_info += f" | ⏳ #{position}"
+        msg += f"🆔 `{t['id']}` | {t['status']} | {t['progress']}{frag_info}\n🔗 {t['url']}\n\n"
+    msg += cache_line
     await update.message.reply_text(msg)
 
 async def clean_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ALLOWED_USER_ID: return
-    manager.tasks.clear()
+    manager.clean_memory()
     await update.message.reply_text(T('clean_done'))
 
 async def clean_uploaded_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -294,29 +440,41 @@ async def clean_uploaded_command(update: Update, context: ContextTypes.DEFAULT_T
     ]]
     await update.message.reply_text(T('confirm_clean_ul'), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
 
-async def files_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ALLOWED_USER_ID: return
-    files = manager.get_local_files()
-    if not files:
-        await update.message.reply_text(T('files_empty'))
-        return
-    global FILE_CACHE
-    FILE_CACHE = files 
+def files_page(page=0, sort='name'):
+    """One page of /files: text and keyboard (buttons carry stable file IDs), or None if there are no files"""
+    files, page, pages, total = manager.files.page(page, FILES_PER_PAGE, sort)
+    if not files: return None
     msg = T('files_header')
     keyboard = []
-    for idx, f in enumerate(files):
-        size_mb = os.path.getsize(os.path.join(manager.base_dir, f)) / (1024*1024)
-        msg += f"📄 `{f}` ({size_mb:.1f} MB)\n"
+    for n, f in enumerate(files, page * FILES_PER_PAGE + 1):
+        msg += f"{n}. 📄 `{f.name}` ({f.size / (1024*1024):.1f} MB)\n"
         keyboard.append([
-            InlineKeyboardButton(T('btn_upload'), callback_data=f"uploc_{idx}"),
-            InlineKeyboardButton(T('btn_delete'), callback_data=f"deloc_{idx}")
+            InlineKeyboardButton(f"{n}. {T('btn_upload')}", callback_data=f"uploc_{f.id}"),
+            InlineKeyboardButton(f"{n}. {T('btn_delete')}", callback_data=f"deloc_{f.id}")
         ])
-    await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    msg += T('files_page', page + 1, pages, total)
+    nav = []
+    if page > 0: nav.append(InlineKeyboardButton("⬅️", callback_data=f"fpage_{sort}_{page - 1}"))
+    if page < pages - 1: nav.append(InlineKeyboardButton("➡️", callback_data=f"fpage_{sort}_{page + 1}"))
+    if nav: keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton(("• " if key == sort else "") + T(f'sort_{key}'), callback_data=f"fpage_{key}_0")
+                     for key in manager.files.SORTS])
+    return msg, InlineKeyboardMarkup(keyboard)
+
+async def files_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ALLOWED_USER_ID: return
+    rendered = files_page()
+    if not rendered:
+        await update.message.reply_text(T('files_empty'))
+        return
+    msg, markup = rendered
+    await update.message.reply_text(msg, reply_markup=markup, parse_mode='Markdown')
 
 async def speedtest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ALLOWED_USER_ID: return
     msg = await update.message.reply_text(T('speedtest_start'), parse_mode='Markdown')
     def run_speedtest_sync():
+        import speedtest
         st = speedtest.Speedtest()
         st.get_best_server()
         return st.results.dict(), st.download()/1e6, st.upload()/1e6
@@ -339,6 +497,8 @@ async def speedtest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- SYSTEM COMMANDS ---
 def restart_process():
+    # In-flight downloads are resumed from their .part files on the next start
+    manager.save_state(force=True)
     python = sys.executable
     script_path = os.path.abspath(__file__)
     project_root = os.path.dirname(os.path.dirname(script_path))
@@ -368,12 +528,12 @@ async def update_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def refresh_menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Dynamic menu based on language
     desc_en = {
-        'start': "Start Bot", 'quality': "Quality Settings", 'files': "Pending Files",
+        'start': "Start Bot", 'quality': "Quality Settings", 'files': "Pending Files", 'pipe': "Pipe-through Uploads", 'bw': "Bandwidth",
         'status': "Status", 'clean_uploaded': "Clean Uploaded", 'speedtest': "Speedtest",
         'update': "Update Bot", 'restart': "Restart", 'language': "Change Language", 'help': "Help"
     }
     desc_es = {
-        'start': "Iniciar", 'quality': "Config Calidad", 'files': "Archivos Pendientes",
+        'start': "Iniciar", 'quality': "Config Calidad", 'files': "Archivos Pendientes", 'pipe': "Subir al Descargar", 'bw': "Ancho de Banda",
         'status': "Estado", 'clean_uploaded': "Limpiar Subidos", 'speedtest': "Velocidad",
         'update': "Actualizar", 'restart': "Reiniciar", 'language': "Cambiar Idioma", 'help': "Ayuda"
     }
@@ -383,7 +543,8 @@ async def refresh_menu_command(update: Update, context: ContextTypes.DEFAULT_TYP
     commands = [
         BotCommand("start", desc['start']), BotCommand("language", desc['language']),
         BotCommand("files", desc['files']), BotCommand("status", desc['status']),
-        BotCommand("quality", desc['quality']), BotCommand("clean_uploaded", desc['clean_uploaded']),
+        BotCommand("quality", desc['quality']), BotCommand("pipe", desc['pipe']), BotCommand("bw", desc['bw']),
+        BotCommand("clean_uploaded", desc['clean_uploaded']),
         BotCommand("speedtest", desc['speedtest']), BotCommand("update", desc['update']),
         BotCommand("restart", desc['restart']), BotCommand("help", desc['help']),
     ]
@@ -394,6 +555,22 @@ async def refresh_menu_command(update: Update, context: ContextTypes.DEFAULT_TYP
 async def post_init(application):
     # Default to English menu on init, will update on user interaction
     await refresh_menu_command(None, MockContext(application.bot))
+    progress_editor.start(application.bot)
+    await userbot.start()
+    await resume_interrupted(application.bot)
+
+async def post_shutdown(application):
+    await userbot.stop()
+    # Saves the pooled instances' cookies and closes their connections
+    ydl_pool.close_all()
+
+async def resume_interrupted(bot):
+    """Restarts downloads cut by a restart; yt-dlp continues from the .part files"""
+    for task in manager.get_interrupted_tasks():
+        chat_id = task['chat_id'] or ALLOWED_USER_ID
+        size_mb = (task['downloaded_bytes'] or 0) / (1024 * 1024)
+        msg = await bot.send_message(chat_id=chat_id, text=T('resuming', task['id'], size_mb), parse_mode='Markdown')
+        asyncio.create_task(download_phase(task['id'], chat_id, msg.message_id, bot, task_quality(task), single_file=task.get('single_file', False)))
 
 class MockContext:
     def __init__(self, bot):
@@ -401,21 +578,520 @@ class MockContext:
 
 # --- CORE LOGIC ---
 
-async def upload_with_userbot(file_path, filename, target_username, status_msg):
-    """Uploads file using Telethon (Userbot). Tries to send as streamable video."""
-    async with TelegramClient(SESSION_PATH, API_ID, API_HASH) as client:
-        # supports_streaming=True tells Telegram to treat it as a video if possible
-        await client.send_file(
-            target_username, 
-            file_path, 
+def progress_text(event):
+    """Progress line for a bus event (bar, percent, speed, ETA)"""
+    if event.phase == 'processing':
+        return T('progress_processing')
+    fraction = event.fraction
+    if fraction is None:
+        bar, pct = "░" * 10, "?"
+    else:
+        bar, pct = "█" * int(fraction * 10) + "░" * (10 - int(fraction * 10)), f"{fraction * 100:.1f}%"
+    speed = f"{event.speed / (1024 * 1024):.1f} MB/s" if event.speed else "-"
+    eta = f"{int(event.eta) // 60}:{int(event.eta) % 60:02d}" if event.eta is not None else "-"
+    return T('progress_line', bar, pct, speed, eta)
+
+class ProgressEditor:
+    """
+    Edits live progress into each active task's status message.
+    Pending edits are merged per message (only the newest text is sent), edits that
+    wouldn't change the text are skipped, each chat gets at most one edit every
+    EDIT_CHAT_INTERVAL seconds, all chats share EDIT_GLOBAL_RATE edits per second,
+    and a RetryAfter pauses every edit for as long as Telegram asks.
+    """
+    def __init__(self):
+        self.bot = None
+        self.loop = None
+        self.wakeup = None
+        self.tracked = {} # { task_id: (chat_id, message_id, header) }
+        self.pending = {} # { (chat_id, message_id): (task_id, text) }
+        self.last_text = {} # { (chat_id, message_id): text last sent }
+        self.chat_next = {} # { chat_id: earliest time for the next edit }
+        self.sending = {} # { (chat_id, message_id): asyncio.Task of the edit in flight }
+        self.paused_until = 0
+        self.tokens = EDIT_GLOBAL_RATE
+        self.refill_at = 0
+
+    def start(self, bot):
+        self.bot = bot
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        # Bus callbacks run on download threads: hand the events over to the loop
+        progress_bus.subscribe(lambda events: self.loop.call_soon_threadsafe(self.on_events, events), interval=1.0)
+        asyncio.create_task(self.run())
+
+    def track(self, task_id, chat_id, message_id, header):
+        """Shows live progress under `header` in the task's message"""
+        self.tracked[task_id] = (chat_id, message_id, header)
+        self.last_text[(chat_id, message_id)] = header
+
+    async def release(self, task_id):
+        """Stops live edits for the task; waits for an edit in flight so it can't land after the caller's"""
+        target = self.tracked.pop(task_id, None)
+        if not target: return
+        key = target[:2]
+        self.pending.pop(key, None)
+        self.last_text.pop(key, None)
+        edit = self.sending.get(key)
+        if edit:
+            await asyncio.gather(edit, return_exceptions=True)
+
+    def on_events(self, events):
+        for event in events:
+            if event.phase not in ('downloading', 'processing'): continue
+            # Tasks attached to the same download share the leader's events
+            for task_id in manager.attached_to(event.key):
+                target = self.tracked.get(task_id)
+                if not target: continue
+                chat_id, message_id, header = target
+                text = f"{header}\n\n{progress_text(event)}"
+                if self.last_text.get((chat_id, message_id)) == text:
+                    self.pending.pop((chat_id, message_id), None)
+                    continue
+                self.pending[(chat_id, message_id)] = (task_id, text)
+        if self.pending:
+            self.wakeup.set()
+
+    def take_token(self, now):
+        if now >= self.refill_at:
+            self.tokens, self.refill_at = EDIT_GLOBAL_RATE, now + 1.0
+        if self.tokens <= 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    for key in list(self.pending):
+                        if key in self.sending or self.chat_next.get(key[0], 0) > now: continue
+                        if not self.take_token(now): break
+                        task_id, text = self.pending.pop(key)
+                        self.chat_next[key[0]] = now + EDIT_CHAT_INTERVAL
+                        self.sending[key] = asyncio.create_task(self.edit(key, task_id, text))
+                    next_times = [self.chat_next.get(k[0], 0) for k in self.pending if k not in self.sending]
+                    wait = max(min(next_times, default=now + 0.5), self.refill_at if self.tokens <= 0 else 0) - now
+                try:
+                    # New events or a finished edit can make something sendable earlier
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=max(wait, 0.05))
+                    self.wakeup.clear()
+                except asyncio.TimeoutError:
+                    pass
+
+    async def edit(self, key, task_id, text):
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                             reply_markup=get_keyboard(task_id, 'downloading'), parse_mode='Markdown')
+            if task_id in self.tracked:
+                self.last_text[key] = text
+        except RetryAfter as e:
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            logger.warning(f"Progress edits paused for {delay}s (flood control)")
+            self.paused_until = time.monotonic() + delay
+            # Retry later unless a newer text arrived meanwhile
+            if task_id in self.tracked:
+                self.pending.setdefault(key, (task_id, text))
+        except BadRequest as e:
+            # "Message is not modified", deleted message... nothing to retry
+            logger.debug(f"Progress edit skipped: {e}")
+        except Exception as e:
+            logger.warning(f"Progress edit failed: {e}")
+        finally:
+            self.sending.pop(key, None)
+            self.wakeup.set()
+
+progress_editor = ProgressEditor()
+
+class UploadPacer:
+    """Paces an upload to the share of the upload budget the scheduler gives its task"""
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.rate = None
+        self.start = time.monotonic()
+        self.sent = 0
+
+    async def consume(self, nbytes):
+        rate = manager.bandwidth.rate_for('up', self.task_id)
+        if rate != self.rate:
+            # New share (budget or other uploads changed): restart the measuring window
+            self.rate, self.start, self.sent = rate, time.monotonic(), 0
+        self.sent += nbytes
+        if rate:
+            ahead = self.sent / rate - (time.monotonic() - self.start)
+            if ahead > 0: await asyncio.sleep(ahead)
+
+class PacedFile:
+    """File-like object for Telethon whose reads follow an UploadPacer"""
+    def __init__(self, file_path, pacer):
+        self.name = os.path.basename(file_path)
+        self.fh = open(file_path, 'rb')
+        self.pacer = pacer
+
+    async def read(self, size=-1):
+        data = self.fh.read(size)
+        await self.pacer.consume(len(data))
+        return data
+
+    def close(self):
+        self.fh.close()
+
+class UserbotClient:
+    """
+    One long-lived Telethon client shared by every userbot upload: the MTProto
+    connection, auth key and DC are set up once in post_init, not per file, and
+    only one client touches the session file. A background check reconnects it
+    if the connection drops, and `session()` admits at most `limit` uploads at once.
+    """
+    def __init__(self, limit):
+        self.client = None
+        self.slots = asyncio.Semaphore(limit)
+        self.connect_lock = asyncio.Lock()
+        self.health_task = None
+
+    async def start(self):
+        if not API_ID or not API_HASH:
+            logger.info("Userbot disabled (API_ID/API_HASH not set)")
+            return
+        try:
+            await self.connect()
+        except Exception as e:
+            logger.error(f"Userbot connect failed: {e}")
+        self.health_task = asyncio.create_task(self.health_loop())
+
+    async def connect(self):
+        """Connects (or reconnects) the shared client; safe to call concurrently"""
+        async with self.connect_lock:
+            if self.client is None:
+                from telethon import TelegramClient
+                self.client = TelegramClient(SESSION_PATH, API_ID, API_HASH)
+            if self.client.is_connected():
+                return self.client
+            await self.client.connect()
+            if not await self.client.is_user_authorized():
+                raise RuntimeError("Userbot session not authorized (run setup_session.py)")
+            logger.info("Userbot connected")
+            return self.client
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(USERBOT_HEALTH_INTERVAL)
+            try:
+                if self.client is None or not self.client.is_connected():
+                    await self.connect()
+                else:
+                    await self.client.get_me()
+            except Exception as e:
+                logger.warning(f"Userbot health check failed: {e}")
+                if self.client is not None:
+                    # Drop the broken connection so the next check/upload starts clean
+                    await self.client.disconnect()
+
+    @asynccontextmanager
+    async def session(self):
+        """Borrows the connected client for one upload (waits for a free slot)"""
+        if not API_ID or not API_HASH:
+            raise RuntimeError("Userbot disabled (API_ID/API_HASH not set)")
+        async with self.slots:
+            yield await self.connect()
+
+    async def stop(self):
+        if self.health_task: self.health_task.cancel()
+        if self.client: await self.client.disconnect()
+
+userbot = UserbotClient(USERBOT_CONCURRENCY)
+
+def video_attributes(url):
+    """Telethon video attributes from the cached yt-dlp info (files sent as InputFile carry no metadata)"""
+    info = info_cache.get(url) or {}
+    if info.get('vcodec') in (None, 'none') or not info.get('duration'):
+        return None
+    from telethon.tl.types import DocumentAttributeVideo
+    return [DocumentAttributeVideo(int(info['duration']), info.get('width') or 0, info.get('height') or 0, supports_streaming=True)]
+
+async def upload_parts_parallel(client, file_path, filename, connections, pacer=None):
+    """
+    Uploads the file's parts over `connections` extra MTProto senders to our own DC,
+    several parts in flight at once. They reuse the session's auth key, so opening them
+    is a TCP connect plus initConnection, not a new authorization. Returns the InputFileBig.
+    """
+    from telethon.network import MTProtoSender
+    from telethon.tl.alltlobjects import LAYER
+    from telethon.tl.functions import InvokeWithLayerRequest
+    from telethon.tl.functions.help import GetConfigRequest
+    from telethon.tl.types import InputFileBig
+    from telethon.tl.functions.upload import SaveBigFilePartRequest
+    loop = asyncio.get_running_loop()
+    size = os.path.getsize(file_path)
+    total_parts = (size + UPLOAD_PART_SIZE - 1) // UPLOAD_PART_SIZE
+    file_id = random.getrandbits(63)
+    dc = await client._get_dc(client.session.dc_id)
+
+    async def open_sender():
+        sender = MTProtoSender(client.session.auth_key, loggers=client._log)
+        await sender.connect(client._connection(dc.ip_address, dc.port, dc.id, loggers=client._log,
+                                                proxy=client._proxy, local_addr=client._local_addr))
+        init = copy.copy(client._init_request)
+        init.query = GetConfigRequest()
+        await sender.send(InvokeWithLayerRequest(LAYER, init))
+        return sender
+
+    opened = await asyncio.gather(*[open_sender() for _ in range(connections)], return_exceptions=True)
+    senders = [x for x in opened if not isinstance(x, Exception)]
+    try:
+        if not senders:
+            raise opened[0]
+        parts = iter(range(total_parts)) # Shared by the workers: each part is taken once
+
+        async def worker(sender):
+            with open(file_path, 'rb') as fh:
+                for index in parts:
+                    fh.seek(index * UPLOAD_PART_SIZE)
+                    data = await loop.run_in_executor(None, fh.read, UPLOAD_PART_SIZE)
+                    if pacer: await pacer.consume(len(data))
+                    for attempt in range(3):
+                        try:
+                            if await sender.send(SaveBigFilePartRequest(file_id, index, total_parts, data)):
+                                break
+                            raise IOError(f"Part {index} rejected")
+                        except Exception:
+                            if attempt == 2: raise
+                            await asyncio.sleep(1 + attempt)
+
+        workers = [asyncio.create_task(worker(sender)) for sender in senders]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # One worker failed (or we were cancelled): stop the rest before their senders go away
+            for task in workers: task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    finally:
+        for sender in senders:
+            await sender.disconnect()
+    return InputFileBig(file_id, total_parts, filename), len(senders)
+
+async def upload_with_userbot(file_path, filename, target_username, status_msg, pacer=None, attributes=None):
+    """
+    Uploads file using Telethon (Userbot). Tries to send as streamable video.
+    Big files go up over USERBOT_CONNECTIONS parallel senders. Returns the throughput.
+    """
+    async with userbot.session() as client:
+        size = os.path.getsize(file_path)
+        started = time.monotonic()
+        source, connections = None, 1
+        try:
+            if USERBOT_CONNECTIONS > 1 and size > 10 * 1024 * 1024:
+                # Parts of files over 10MB can go in any order (SaveBigFilePart)
+                file, connections = await upload_parts_parallel(client, file_path, filename, USERBOT_CONNECTIONS, pacer)
+            else:
+                file = source = PacedFile(file_path, pacer) if pacer else file_path
+            # supports_streaming=True tells Telegram to treat it as a video if possible
+            message = await client.send_file(
+                target_username, 
+                file, 
+                file_size=size,
+                caption=f"✅ **{filename}**\n_(Userbot Video)_",
+                attributes=attributes,
+                force_document=False,
+                supports_streaming=True
+            )
+        finally:
+            if isinstance(source, PacedFile): source.close()
+
+    seconds = max(time.monotonic() - started, 0.001)
+    stats = {'bytes': size, 'seconds': seconds, 'speed': size / seconds, 'connections': connections}
+    # Reference for re-sending the same document later without uploading it again
+    document = getattr(message, 'document', None)
+    if document:
+        stats['document'] = [document.id, document.access_hash, document.file_reference.hex()]
+    logger.info(f"Userbot upload {filename}: {size / 1048576:.1f} MB in {seconds:.1f}s "
+                f"({stats['speed'] / 1048576:.1f} MB/s, {connections} connections)")
+    return stats
+
+async def upload_stream_with_userbot(source, filename, target_username, attributes=None, pacer=None):
+    """
+    Uploads a file that is still being written (MTProto streamed upload).
+    The total part count is unknown until the writer closes, so every part but
+    the last is sent with file_total_parts=-1. Returns the sent document's reference.
+    """
+    from telethon.tl.types import InputFileBig
+    from telethon.tl.functions.upload import SaveBigFilePartRequest
+    loop = asyncio.get_running_loop()
+    async with userbot.session() as client:
+        file_id = random.getrandbits(63)
+        part_index = 0
+        current = await loop.run_in_executor(None, source.read, STREAM_PART_SIZE)
+        if not current:
+            raise IOError("Empty file")
+        while True:
+            # Read one part ahead: a short or empty read means `current` is the last part
+            nxt = await loop.run_in_executor(None, source.read, STREAM_PART_SIZE) if len(current) == STREAM_PART_SIZE else b''
+            total_parts = part_index + 1 if not nxt else -1
+            if pacer: await pacer.consume(len(current))
+            await client(SaveBigFilePartRequest(file_id, part_index, total_parts, current))
+            part_index += 1
+            if not nxt: break
+            current = nxt
+
+        message = await client.send_file(
+            target_username,
+            InputFileBig(file_id, part_index, filename),
             caption=f"✅ **{filename}**\n_(Userbot Video)_",
+            attributes=attributes,
             force_document=False,
             supports_streaming=True
         )
+    # Reference for re-sending the same document later without uploading it again
+    document = getattr(message, 'document', None)
+    return [document.id, document.access_hash, document.file_reference.hex()] if document else None
+
+async def remember_file_id(task, entry):
+    """Stores the file_id of a sent task under its video id and the content hash of its file"""
+    keys = [f"vid:{task['content_key']}"] if task.get('content_key') else []
+    try:
+        if task['file_path'] and os.path.exists(task['file_path']):
+            keys += await asyncio.get_running_loop().run_in_executor(None, manager.file_id_keys, task['file_path'])
+        if keys: manager.file_ids.record(keys, entry)
+    except Exception as e:
+        logger.warning(f"Could not cache file_id for {task['filename']}: {e}")
+
+async def send_by_reference(entry, bot, chat_id, filename):
+    """Re-sends an already delivered file by its file_id (Bot API) or document reference (userbot)"""
+    if entry['via'] == 'bot':
+        if entry['kind'] == 'video':
+            await bot.send_video(chat_id=chat_id, video=entry['file_id'], caption=f"✅ {filename}", supports_streaming=True)
+        else:
+            await bot.send_document(chat_id=chat_id, document=entry['file_id'], caption=f"✅ {filename}")
+        return
+    from telethon.tl.types import InputDocument
+    doc_id, access_hash, file_reference = entry['document']
+    bot_info = await bot.get_me()
+    async with userbot.session() as client:
+        await client.send_file(bot_info.username, InputDocument(doc_id, access_hash, bytes.fromhex(file_reference)),
+                               caption=f"✅ **{filename}**\n_(Userbot Video)_", force_document=False, supports_streaming=True)
+
+async def send_cached(task_id, bot, chat_id, message_id):
+    """
+    Delivers the task's content by reference if it was sent before (same video id or
+    same content). Returns False when there's nothing cached or the reference expired,
+    so the caller does a real upload. Only files up to PRE_UPLOAD_HASH_LIMIT are hashed
+    here; bigger ones match by content only if their hash is already known.
+    """
+    task = manager.get_task(task_id)
+    if not task: return False
+    file_path = task['file_path']
+    local = bool(file_path) and os.path.exists(file_path)
+    # Video id keys are free; a missing file here means run_download skipped it for a stored file_id
+    keys = [f"vid:{task['content_key']}"] if task.get('content_key') else []
+    if local:
+        with_hash = os.path.getsize(file_path) <= PRE_UPLOAD_HASH_LIMIT
+        keys += await asyncio.get_running_loop().run_in_executor(None, manager.file_id_keys, file_path, with_hash)
+    entry = manager.file_ids.lookup(keys)
+    if not entry: return False
+
+    try:
+        await send_by_reference(entry, bot, chat_id, task['filename'])
+    except Exception as e:
+        logger.info(f"Cached file_id for {task['filename']} no longer valid: {e}")
+        manager.file_ids.forget(keys)
+        if local: return False
+        # Nothing on disk to upload instead: a retry downloads it for real
+        manager.update_status(task_id, 'failed_dl', 'Cached file_id expired')
+        await bot.edit_message_text(T('error_generic', 'Cached file_id expired'), chat_id=chat_id, message_id=message_id,
+                                    reply_markup=get_keyboard(task_id, 'failed_dl'))
+        return True
+
+    manager.update_status(task_id, 'completed')
+    manager.archive_task_file(task_id)
+    await bot.edit_message_text(
+        T('upload_cached', task['filename']),
+        chat_id=chat_id, message_id=message_id,
+        reply_markup=get_keyboard(task_id, 'completed'), parse_mode='Markdown'
+    )
+    return True
+
+async def needs_segments(file_path):
+    """Files over SEGMENT_MAX_BYTES (or longer than SEGMENT_MAX_SECONDS) are sent as a series of parts"""
+    if not manager.downloader.has_ffmpeg: return False
+    if os.path.getsize(file_path) > SEGMENT_MAX_BYTES: return True
+    if SEGMENT_MAX_SECONDS:
+        duration = await asyncio.get_running_loop().run_in_executor(None, manager.downloader.probe_duration, file_path)
+        return bool(duration and duration > SEGMENT_MAX_SECONDS)
+    return False
+
+async def upload_segments(task_id, bot, chat_id, message_id):
+    """
+    Cuts the task's file into parts on keyframes (no re-encoding) and uploads each
+    part as soon as ffmpeg closes it, while the next ones are still being cut.
+    Parts go one at a time so they arrive as an ordered series. Each part is deleted
+    once sent: only the original is archived.
+    """
+    task = manager.get_task(task_id)
+    file_path = task['file_path']
+    size = os.path.getsize(file_path)
+    await bot.edit_message_text(T('segment_start', task['filename'], size / 1048576),
+                                chat_id=chat_id, message_id=message_id, parse_mode='Markdown')
+    loop = asyncio.get_running_loop()
+    # ffmpeg may cut ahead of the uploads: at worst the parts add up to a second copy
+    reservation = f"{task_id}:parts"
+    if not manager.quota.reserve(reservation, size):
+        manager.update_status(task_id, 'failed_ul', 'Not enough disk space')
+        await bot.edit_message_text(T('segment_error', 0, 'Not enough disk space'), chat_id=chat_id, message_id=message_id,
+                                    reply_markup=get_keyboard(task_id, 'failed_ul'))
+        return
+    parts = manager.downloader.iter_segments(file_path, SEGMENT_MAX_BYTES, SEGMENT_MAX_SECONDS or None)
+    count = sent = 0
+    try:
+        while True:
+            part = await loop.run_in_executor(None, next, parts, None)
+            if part is None: break
+            count += 1
+            part_id = manager.create_task_from_file(os.path.relpath(part, manager.base_dir))
+            msg = await bot.send_message(chat_id=chat_id, text=T('segment_part', count, os.path.basename(part)), parse_mode='Markdown')
+            await upload_lanes.run(part_id, bot, chat_id, msg.message_id, split=False)
+            uploaded = manager.get_task(part_id)['status'] == 'completed'
+            # Sent (or failed) parts are not kept: a retry cuts the file again
+            manager.delete_task_data(part_id)
+            if not uploaded:
+                raise IOError(f"part {count} was not uploaded")
+            sent += 1
+    except Exception as e:
+        logger.error(f"Segmented upload failed: {traceback.format_exc()}")
+        manager.update_status(task_id, 'failed_ul', str(e))
+        await bot.edit_message_text(T('segment_error', sent, str(e)[:50]), chat_id=chat_id, message_id=message_id,
+                                    reply_markup=get_keyboard(task_id, 'failed_ul'))
+        return
+    finally:
+        # Stops ffmpeg if the series was cut short, and drops the parts it cut but weren't sent
+        await loop.run_in_executor(None, parts.close)
+        for number in range(count + 1, count + 1000):
+            leftover = manager.downloader.segment_path(file_path, number)
+            if not os.path.exists(leftover): break
+            manager.quota.discard(leftover)
+            os.remove(leftover)
+        manager.quota.release(reservation)
+
+    manager.update_status(task_id, 'completed')
+    manager.archive_task_file(task_id)
+    await bot.edit_message_text(T('segment_done', sent, task['filename']), chat_id=chat_id, message_id=message_id,
+                                reply_markup=get_keyboard(task_id, 'completed'), parse_mode='Markdown')
 
 async def upload_file(task_id, bot, chat_id, message_id):
     task = manager.get_task(task_id)
-    if not task or not task['file_path']: return
+    if not task or not task['file_path']:
+        # Nothing on disk (e.g. a task that was only ever re-sent by reference)
+        if task: manager.update_status(task_id, 'failed_dl', 'File not found')
+        await bot.edit_message_text(T('file_not_found'), chat_id=chat_id, message_id=message_id,
+                                    reply_markup=get_keyboard(task_id, 'failed_dl') if task else None)
+        return
+    # Bot API uploads count towards the upload budget but can't be paced
+    # (python-telegram-bot reads the whole file into the request)
+    manager.bandwidth.join('up', task_id, task.get('priority') or 'normal')
     try:
         file_path = task['file_path']
         if not os.path.exists(file_path):
@@ -431,45 +1107,52 @@ async def upload_file(task_id, bot, chat_id, message_id):
             bot_info = await bot.get_me()
             
             try:
-                await upload_with_userbot(file_path, task['filename'], bot_info.username, message_id)
+                stats = await upload_with_userbot(file_path, task['filename'], bot_info.username, message_id,
+                                                  UploadPacer(task_id), video_attributes(task['url']))
             except Exception as e:
                 # If video upload fails (rare), we could retry as document, but Telethon usually handles this.
                 raise e 
             
+            if stats.get('document'):
+                await remember_file_id(task, {'via': 'userbot', 'document': stats['document']})
             manager.update_status(task_id, 'completed')
             manager.archive_task_file(task_id)
             
-            await bot.send_message(chat_id=chat_id, text=T('upload_userbot_success'), parse_mode='Markdown')
+            speed = T('upload_speed', stats['bytes'] / 1048576, stats['seconds'], stats['speed'] / 1048576, stats['connections'])
+            await bot.send_message(chat_id=chat_id, text=f"{T('upload_userbot_success')}\n{speed}", parse_mode='Markdown')
             await bot.delete_message(chat_id=chat_id, message_id=message_id)
         
         # --- SMALL FILES (<50MB) via BOT API ---
         else:
             await bot.edit_message_text(T('upload_bot', task['filename'], size_mb), chat_id=chat_id, message_id=message_id, parse_mode='Markdown')
             
-            uploaded = False
+            sent = None
             # 1. Try sending as Video (Streamable)
             if is_video:
                 try:
-                    await bot.send_video(
+                    sent = await bot.send_video(
                         chat_id=chat_id, 
                         video=open(file_path, 'rb'), 
                         read_timeout=3600, write_timeout=3600, connect_timeout=60, pool_timeout=3600,
                         caption=f"✅ {task['filename']}",
                         supports_streaming=True
                     )
-                    uploaded = True
                 except Exception as e:
                     logger.warning(f"send_video failed, retrying as document: {e}")
             
             # 2. Fallback: Send as Document
-            if not uploaded:
-                await bot.send_document(
+            if not sent:
+                sent = await bot.send_document(
                     chat_id=chat_id, 
                     document=open(file_path, 'rb'), 
                     read_timeout=3600, write_timeout=3600, connect_timeout=60, pool_timeout=3600,
                     caption=f"✅ {task['filename']}"
                 )
 
+            if sent.video:
+                await remember_file_id(task, {'via': 'bot', 'kind': 'video', 'file_id': sent.video.file_id})
+            elif sent.document:
+                await remember_file_id(task, {'via': 'bot', 'kind': 'document', 'file_id': sent.document.file_id})
             manager.update_status(task_id, 'completed')
             manager.archive_task_file(task_id)
             await bot.edit_message_text(
@@ -486,39 +1169,268 @@ async def upload_file(task_id, bot, chat_id, message_id):
             chat_id=chat_id, message_id=message_id, 
             reply_markup=get_keyboard(task_id, 'failed_ul')
         )
+    finally:
+        manager.bandwidth.leave('up', task_id)
+
+class UploadLanes:
+    """
+    Upload queue with two lanes: Bot API (files up to BOT_API_UPLOAD_LIMIT) and
+    MTProto (userbot, bigger files). Each lane runs at most UPLOAD_LANE_LIMITS uploads
+    and has its own ordering: the Bot API lane sends the smallest file first so quick
+    uploads don't wait behind slow ones; the MTProto lane goes by task priority, then
+    arrival. Queued uploads show up in /status and can be cancelled.
+    """
+    def __init__(self, limits):
+        self.lanes = {name: {'limit': limit, 'running': 0, 'queue': []} for name, limit in limits.items()}
+        self.seq = 0
+
+    @staticmethod
+    def lane_for(size):
+        return 'bot' if size <= BOT_API_UPLOAD_LIMIT else 'mtproto'
+
+    @staticmethod
+    def _rank(lane, job):
+        if lane == 'bot':
+            return (job['size'], job['seq'])
+        return (-manager.bandwidth.PRIORITIES.get(job['priority'], 2), job['seq'])
+
+    def _ordered(self, lane):
+        return sorted(self.lanes[lane]['queue'], key=lambda job: self._rank(lane, job))
+
+    def _dispatch(self, lane):
+        state = self.lanes[lane]
+        for job in self._ordered(lane):
+            if state['running'] >= state['limit']: break
+            state['queue'].remove(job)
+            if job['go'].done(): continue # Its waiter was cancelled
+            state['running'] += 1
+            job['go'].set_result(True)
+
+    def _release(self, lane):
+        self.lanes[lane]['running'] -= 1
+        self._dispatch(lane)
+
+    async def run(self, task_id, bot, chat_id, message_id, split=True):
+        """
+        Waits for a slot in the file's lane, then uploads it (replaces calling upload_file directly).
+        With split, oversize files are sent as a series of parts instead (each part comes back here).
+        """
+        # Already on Telegram: re-send by reference without taking a lane slot
+        if await send_cached(task_id, bot, chat_id, message_id): return
+        task = manager.get_task(task_id)
+        if not task or not task['file_path'] or not os.path.exists(task['file_path']):
+            # upload_file reports the missing file
+            await upload_file(task_id, bot, chat_id, message_id)
+            return
+        if split and await needs_segments(task['file_path']):
+            await upload_segments(task_id, bot, chat_id, message_id)
+            return
+        self.seq += 1
+        lane = self.lane_for(os.path.getsize(task['file_path']))
+        job = {'task_id': task_id, 'size': os.path.getsize(task['file_path']), 'priority': task.get('priority'),
+               'seq': self.seq, 'go': asyncio.get_running_loop().create_future()}
+        self.lanes[lane]['queue'].append(job)
+        self._dispatch(lane)
 
-async def download_phase(task_id, chat_id, message_id, bot, quality):
+        try:
+            if not job['go'].done():
+                position = self.position(task_id)[1]
+                # A failed edit must not leave the job orphaned in the lane
+                try:
+                    await bot.edit_message_text(T('upload_queued', lane, position, task['filename']), chat_id=chat_id, message_id=message_id,
+                                                reply_markup=get_keyboard(task_id, 'upload_queued'), parse_mode='Markdown')
+                except Exception: pass
+            go = await job['go']
+        except asyncio.CancelledError:
+            # Cancelled while waiting: give up the place in the queue, or the slot it was just handed
+            if job in self.lanes[lane]['queue']:
+                self.lanes[lane]['queue'].remove(job)
+            elif job['go'].done() and not job['go'].cancelled() and job['go'].result():
+                self._release(lane)
+            raise
+        if not go:
+            await bot.edit_message_text(T('upload_cancelled'), chat_id=chat_id, message_id=message_id,
+                                        reply_markup=get_keyboard(task_id, 'success'))
+            return
+        try:
+            await upload_file(task_id, bot, chat_id, message_id)
+        finally:
+            self._release(lane)
+
+    def cancel(self, task_id):
+        """Removes a queued (not yet started) upload"""
+        for state in self.lanes.values():
+            for job in state['queue']:
+                if job['task_id'] == task_id:
+                    state['queue'].remove(job)
+                    job['go'].set_result(False)
+                    return True
+        return False
+
+    def position(self, task_id):
+        """(lane, 1-based position) of a queued upload, or None"""
+        for lane in self.lanes:
+            for position, job in enumerate(self._ordered(lane), 1):
+                if job['task_id'] == task_id:
+                    return lane, position
+        return None
+
+    def snapshot(self):
+        return {lane: {'limit': state['limit'], 'running': state['running'], 'queued': len(state['queue']),
+                       'order': [job['task_id'] for job in self._ordered(lane)]}
+                for lane, state in self.lanes.items()}
+
+upload_lanes = UploadLanes(UPLOAD_LANE_LIMITS)
+
+def quality_to_mode(quality):
+    """Maps a bot quality choice to the (mode, quality) pair used by the downloader"""
+    if quality == 'audio':
+        return 'audio', '192'
+    return 'video', quality
+
+def task_quality(task, default='720'):
+    """Bot quality choice a task was downloaded with (inverse of quality_to_mode)"""
+    if task.get('mode') == 'audio': return 'audio'
+    return task.get('quality') or default
+
+async def batch_phase(task_id, chat_id, message_id, bot, quality):
+    """Downloads a playlist entry by entry; each finished entry is uploaded right away"""
     loop = asyncio.get_running_loop()
+    await bot.edit_message_text(T('batch_downloading', quality, task_id, BATCH_PARALLEL), chat_id=chat_id, message_id=message_id, reply_markup=get_keyboard(task_id, 'downloading'), parse_mode='Markdown')
+
+    mode, qual_val = quality_to_mode(quality)
+    batch = manager.run_batch(task_id, mode=mode, quality=qual_val, parallel=BATCH_PARALLEL)
+    uploads = []
+    ok = total = 0
+    while True:
+        # The generator blocks while entries download, so it is advanced off the event loop
+        item = await loop.run_in_executor(None, next, batch, None)
+        if item is None: break
+        entry_id, result = item
+        total += 1
+        if result['status'] == 'success':
+            ok += 1
+            msg = await bot.send_message(chat_id=chat_id, text=T('task_init', entry_id), parse_mode='Markdown')
+            uploads.append(asyncio.create_task(upload_lanes.run(entry_id, bot, chat_id, msg.message_id)))
+        elif result['status'] != 'cancelled':
+            await bot.send_message(chat_id=chat_id, text=T('error_generic', result['message'][:50]), reply_markup=get_keyboard(entry_id, 'failed_dl'))
+
+    await asyncio.gather(*uploads)
+    await bot.edit_message_text(T('batch_done', ok, total), chat_id=chat_id, message_id=message_id, parse_mode='Markdown')
+
+def pick_phase(url):
+    """Chooses how a link is downloaded: playlist batch, pipe-through or regular"""
+    if is_playlist_url(url): return batch_phase
+    if PIPE_THROUGH and API_ID and API_HASH: return pipe_phase
+    return download_phase
+
+async def download_phase(task_id, chat_id, message_id, bot, quality, single_file=False):
+    manager.set_task_origin(task_id, chat_id, message_id)
     await bot.edit_message_text(T('downloading', quality, task_id), chat_id=chat_id, message_id=message_id, reply_markup=get_keyboard(task_id, 'downloading'), parse_mode='Markdown')
+    progress_editor.track(task_id, chat_id, message_id, T('downloading', quality, task_id))
 
+    mode, qual_val = quality_to_mode(quality)
     def run_dl_wrapper():
-        task = manager.get_task(task_id)
-        if not task: return {'status': 'error', 'message': 'Task lost'}
-        
-        def check_cancel(): return manager.tasks[task_id]['cancel_flag']
-        def progress(d):
-            if d['status'] == 'downloading':
-                try: manager.tasks[task_id]['progress'] = d.get('_percent_str', '0%')
-                except: pass
+        return manager.run_download(task_id, mode=mode, quality=qual_val, single_file=single_file)
+
+    future = manager.enqueue(task_id, run_dl_wrapper, mode, qual_val)
+    if future is None:
+        await queue_full(task_id, chat_id, message_id, bot)
+        return
+    result = await asyncio.wrap_future(future)
+    await finish_download(result, task_id, chat_id, message_id, bot)
+
+async def queue_full(task_id, chat_id, message_id, bot):
+    """The scheduler turned the download away: offer a retry"""
+    await progress_editor.release(task_id)
+    await bot.edit_message_text(T('queue_full'), chat_id=chat_id, message_id=message_id, reply_markup=get_keyboard(task_id, 'failed_dl'), parse_mode='Markdown')
 
+async def pipe_phase(task_id, chat_id, message_id, bot, quality):
+    """Downloads a single-stream format and uploads it through the userbot while it grows"""
+    loop = asyncio.get_running_loop()
+    manager.set_task_origin(task_id, chat_id, message_id)
+    await bot.edit_message_text(T('pipe_downloading', quality, task_id), chat_id=chat_id, message_id=message_id, reply_markup=get_keyboard(task_id, 'downloading'), parse_mode='Markdown')
+    progress_editor.track(task_id, chat_id, message_id, T('pipe_downloading', quality, task_id))
+
+    source = GrowingFile()
+    def on_progress(d):
+        if d['status'] == 'downloading' and d.get('tmpfilename'):
+            source.attach(d['tmpfilename'], d.get('filename'))
+
+    mode, qual_val = quality_to_mode(quality)
+    def run_dl_wrapper():
+        result = {'status': 'error', 'message': 'Download crashed'}
         try:
-            mode = 'audio' if quality == 'audio' else 'video'
-            qual_val = 'best' if quality == 'best' else quality
-            if quality == 'audio': qual_val = '192' 
-
-            res = task['downloader'].download(task['url'], mode=mode, quality=qual_val, progress_hook=progress, check_cancel=check_cancel)
-            if res['status'] == 'success':
-                with manager.lock:
-                    manager.tasks[task_id]['file_path'] = res['path']
-                    manager.tasks[task_id]['filename'] = os.path.basename(res['path'])
-                    manager.tasks[task_id]['status'] = 'success'
-            return res
-        except Exception as e:
-            return {'status': 'error', 'message': str(e)}
+            result = manager.run_download(task_id, mode=mode, quality=qual_val, progress_hook=on_progress, single_file=True)
+            return result
+        finally:
+            if result['status'] in ('success', 'pending'): source.finish()
+            else: source.fail(result.get('message'))
+
+    future = manager.enqueue(task_id, run_dl_wrapper, mode, qual_val)
+    if future is None:
+        await queue_full(task_id, chat_id, message_id, bot)
+        return
+    # Cancelled or dropped while queued: the wrapper never runs, so stop waiting for it to start here
+    future.add_done_callback(lambda _: source.finish())
+    dl_future = asyncio.wrap_future(future)
+    # The download thread signals the loop directly, no executor thread waits for it
+    started = loop.create_future()
+    source.on_ready(lambda: loop.call_soon_threadsafe(lambda: started.done() or started.set_result(None)))
+    try:
+        await asyncio.wait_for(started, PIPE_START_TIMEOUT)
+        streaming = source.ready
+    except asyncio.TimeoutError:
+        logger.warning(f"Pipe {task_id}: download did not start in {PIPE_START_TIMEOUT}s, uploading once finished")
+        streaming = False
+    # Served from the index, attached to another task, failed early or too slow to start: nothing to stream
+    if not streaming:
+        await finish_download(await dl_future, task_id, chat_id, message_id, bot)
+        return
 
-    result = await loop.run_in_executor(download_executor, run_dl_wrapper)
+    task = manager.get_task(task_id)
+    attributes = video_attributes(task['url'])
+
+    bot_info = await bot.get_me()
+    filename = os.path.basename(source.paths[1])
+    manager.bandwidth.join('up', task_id, task.get('priority') or 'normal')
+    upload = asyncio.create_task(upload_stream_with_userbot(source, filename, bot_info.username, attributes, UploadPacer(task_id)))
+    result = await dl_future
+    await progress_editor.release(task_id)
+    try:
+        document = await upload
+        upload_error = None
+    except Exception as e:
+        upload_error = e
+    finally:
+        source.close()
+        manager.bandwidth.leave('up', task_id)
 
-    if result['status'] == 'success': await upload_file(task_id, bot, chat_id, message_id)
+    if result['status'] != 'success':
+        await finish_download(result, task_id, chat_id, message_id, bot)
+        return
+    if upload_error:
+        logger.error(f"Pipe upload fail: {upload_error}")
+        manager.update_status(task_id, 'failed_ul', str(upload_error))
+        await bot.edit_message_text(T('upload_error', str(upload_error)[:50]), chat_id=chat_id, message_id=message_id, reply_markup=get_keyboard(task_id, 'failed_ul'))
+        return
+
+    if document:
+        await remember_file_id(manager.get_task(task_id), {'via': 'userbot', 'document': document})
+    manager.update_status(task_id, 'completed')
+    manager.archive_task_file(task_id)
+    await bot.send_message(chat_id=chat_id, text=T('upload_userbot_success'), parse_mode='Markdown')
+    await bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+async def finish_download(result, task_id, chat_id, message_id, bot):
+    """Common handling of a download result: upload it, or report cancel/error"""
+    # Same content already downloading, or ffmpeg still merging: wait without holding a worker thread
+    if result['status'] == 'pending':
+        result = await asyncio.wrap_future(result['future'])
+    await progress_editor.release(task_id)
+
+    if result['status'] == 'success':
+        await upload_lanes.run(task_id, bot, chat_id, message_id)
     elif result['status'] == 'cancelled': 
         await bot.edit_message_text(T('cancel_ok'), chat_id=chat_id, message_id=message_id)
         manager.delete_task_data(task_id)
@@ -527,10 +1439,15 @@ async def download_phase(task_id, chat_id, message_id, bot, quality):
 
 async def analyze_phase(url, update, context):
     task_id = manager.create_task(url)
+    if is_playlist_url(url):
+        # Extracting every entry just to show a title is not worth it
+        await update.message.reply_text(T('playlist_select'), reply_markup=get_quality_keyboard(task_id), parse_mode='Markdown')
+        return
+
     msg = await update.message.reply_text(T('analyzing'), parse_mode='Markdown')
 
     loop = asyncio.get_running_loop()
-    info = await loop.run_in_executor(download_executor, manager.tasks[task_id]['downloader'].get_video_info, url)
+    info = await loop.run_in_executor(download_executor, manager.downloader.get_video_info, url)
 
     if info['status'] == 'error':
         await msg.edit_text(T('error_generic', info['message']))
@@ -556,7 +1473,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if DEFAULT_QUALITY != 'ask':
         task_id = manager.create_task(url)
         msg = await update.message.reply_text(T('task_init', task_id), parse_mode='Markdown')
-        asyncio.create_task(download_phase(task_id, user.id, msg.message_id, context.bot, DEFAULT_QUALITY))
+        asyncio.create_task(pick_phase(url)(task_id, user.id, msg.message_id, context.bot, DEFAULT_QUALITY))
     else:
         await analyze_phase(url, update, context)
 
@@ -601,31 +1518,40 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         quality = parts[1]
         task_id = parts[2]
         await query.edit_message_text(T('quality_selected', quality.upper()), parse_mode='Markdown')
-        asyncio.create_task(download_phase(task_id, query.message.chat_id, query.message.message_id, context.bot, quality))
+        task = manager.get_task(task_id)
+        if not task: return
+        asyncio.create_task(pick_phase(task['url'])(task_id, query.message.chat_id, query.message.message_id, context.bot, quality))
         return
 
     # File Management
+    if data.startswith("fpage_"):
+        _, sort, page = data.split("_")
+        rendered = files_page(int(page), sort if sort in manager.files.SORTS else 'name')
+        if not rendered:
+            await query.edit_message_text(T('files_empty'))
+            return
+        msg, markup = rendered
+        try:
+            await query.edit_message_text(msg, reply_markup=markup, parse_mode='Markdown')
+        except BadRequest: pass # Same page, nothing changed
+        return
+
     if data.startswith("uploc_"):
-        idx = int(data.split("_")[1])
-        if idx < len(FILE_CACHE):
-            fname = FILE_CACHE[idx]
-            tid = manager.create_task_from_file(fname)
-            if tid: 
-                await query.edit_message_text(f"🚀 {fname}...")
-                asyncio.create_task(upload_file(tid, context.bot, query.message.chat_id, query.message.message_id))
+        entry = manager.files.get(data.split("_", 1)[1])
+        tid = manager.create_task_from_file(entry.name) if entry else None
+        if not tid:
+            await query.edit_message_text(T('file_not_found'))
+            return
+        await query.edit_message_text(f"🚀 {entry.name}...")
+        asyncio.create_task(upload_lanes.run(tid, context.bot, query.message.chat_id, query.message.message_id))
         return
     
     if data.startswith("deloc_"):
         try:
-            idx = int(data.split("_")[1])
-            if idx < len(FILE_CACHE):
-                filename = FILE_CACHE[idx]
-                file_path = os.path.join(manager.base_dir, filename)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    await query.edit_message_text(T('delete_ok'))
-                else:
-                    await query.edit_message_text(T('file_not_found'))
+            if manager.delete_local_file(data.split("_", 1)[1]):
+                await query.edit_message_text(T('delete_ok'))
+            else:
+                await query.edit_message_text(T('file_not_found'))
         except: pass
         return
 
@@ -641,20 +1567,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         manager.delete_task_data(task_id)
         await query.edit_message_text(T('delete_ok'))
     elif action == "cancel":
+        # A queued upload: the waiting upload_lanes.run() reports it
+        if upload_lanes.cancel(task_id): return
+        await progress_editor.release(task_id)
         if manager.cancel_task(task_id): await query.edit_message_text(T('cancel_ok'))
     elif action == "log":
         await context.bot.send_message(query.message.chat_id, T('log_header', task.get('last_error', '-')))
     elif action == "retry_dl":
         if manager.reset_task_for_retry(task_id):
             await query.edit_message_text(T('retry_dl'), reply_markup=get_keyboard(task_id, 'downloading'))
-            asyncio.create_task(download_phase(task_id, query.message.chat_id, query.message.message_id, context.bot, '720'))
+            # Same format as the failed attempt, so yt-dlp can continue its .part file
+            asyncio.create_task(download_phase(task_id, query.message.chat_id, query.message.message_id, context.bot, task_quality(task), single_file=task.get('single_file', False)))
     elif action == "retry_ul":
         await query.edit_message_text(T('retry_ul'))
-        asyncio.create_task(upload_file(task_id, context.bot, query.message.chat_id, query.message.message_id))
+        asyncio.create_task(upload_lanes.run(task_id, context.bot, query.message.chat_id, query.message.message_id))
 
 if __name__ == '__main__':
     request = HTTPXRequest(connection_pool_size=8, read_timeout=3600.0, write_timeout=3600.0, connect_timeout=60.0, pool_timeout=60.0)
-    application = ApplicationBuilder().token(TOKEN).request(request).post_init(post_init).build()
+    application = ApplicationBuilder().token(TOKEN).request(request).post_init(post_init).post_shutdown(post_shutdown).build()
 
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('files', files_command))
@@ -666,6 +1596,8 @@ if __name__ == '__main__':
     application.add_handler(CommandHandler('update', update_command))
     application.add_handler(CommandHandler('restart', restart_command))
     application.add_handler(CommandHandler('quality', quality_command))
+    application.add_handler(CommandHandler('pipe', pipe_command))
+    application.add_handler(CommandHandler('bw', bw_command))
     application.add_handler(CommandHandler('language', language_command))
     application.add_handler(CommandHandler('refresh_menu', refresh_menu_command))
     application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
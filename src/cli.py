@@ -1,41 +1,133 @@
 import argparse
 import sys
-from src.core import Downloader
+import json
+import time
+import threading
+import concurrent.futures
+from src.core import get_downloader, FragmentTuner, progress_bus, ydl_pool
 
-def progress_hook(d):
-    if d['status'] == 'downloading':
-        try:
-            p = d.get('_percent_str', 'N/A').replace('%','')
-            print(f"Descargando: {p}% completado", end='\r')
-        except:
-            pass
-    elif d['status'] == 'finished':
+def print_progress(events):
+    """Consumidor del bus para el modo interactivo (una sola descarga)"""
+    event = events[-1]
+    if event.phase == 'downloading':
+        fraction = event.fraction
+        p = f"{fraction * 100:.1f}" if fraction is not None else "N/A"
+        print(f"Descargando: {p}% completado", end='\r')
+    elif event.phase == 'processing':
         print("\nDescarga completada, procesando...")
 
+class JsonLines:
+    """Salida JSON-lines para scripts: una línea por evento, sin mezclar líneas entre hilos"""
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.jobs = {} # { clave del bus: (index, url) }
+
+    def emit(self, event, **fields):
+        line = json.dumps({'event': event, 'time': round(time.time(), 3), **fields}, ensure_ascii=False)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def on_progress(self, events):
+        """Consumidor del bus: como mucho un evento de progreso por trabajo e intervalo"""
+        for event in events:
+            if event.key not in self.jobs or event.phase not in ('downloading', 'processing'): continue
+            index, url = self.jobs[event.key]
+            self.emit('progress', index=index, url=url, phase=event.phase,
+                      downloaded_bytes=event.downloaded, total_bytes=event.total,
+                      speed=event.speed, eta=event.eta)
+
+def read_urls(source):
+    """URLs de un archivo (o '-' para stdin), una por línea; ignora vacías y comentarios (#)"""
+    stream = sys.stdin if source == '-' else open(source, encoding='utf-8')
+    try:
+        for line in stream:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def run_batch(source, mode, quality, jobs, progress_interval=1.0):
+    """
+    Modo lote: descarga todas las URLs de `source` con `jobs` trabajos en paralelo
+    sobre el Downloader compartido. Emite JSON-lines y devuelve el número de fallos.
+    """
+    out = JsonLines()
+    sub = progress_bus.subscribe(out.on_progress, interval=progress_interval)
+    downloader = get_downloader()
+    # Reparte un tope de fragmentos paralelos entre los trabajos activos
+    tuner = FragmentTuner()
+
+    def job(index, url):
+        key = f"cli-{index}"
+        out.jobs[key] = (index, url)
+        out.emit('start', index=index, url=url, mode=mode, quality=quality)
+        try:
+            result = downloader.download(url, mode=mode, quality=quality,
+                                         progress_hook=progress_bus.hook(key),
+                                         fragment_tuner=tuner, task_key=key)
+        except Exception as e:
+            result = {'status': 'error', 'message': str(e)}
+        progress_bus.publish(key, 'done' if result['status'] == 'success' else 'error')
+        out.jobs.pop(key, None)
+        if result['status'] == 'success':
+            out.emit('result', index=index, url=url, status='success', title=result.get('title'), path=result['path'])
+        else:
+            out.emit('result', index=index, url=url, status='error', message=result.get('message'))
+        return result['status'] == 'success'
+
+    ok = failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(job, index, url) for index, url in enumerate(read_urls(source))]
+        for future in concurrent.futures.as_completed(futures):
+            if future.result(): ok += 1
+            else: failed += 1
+    progress_bus.unsubscribe(sub)
+
+    out.emit('summary', total=ok + failed, ok=ok, failed=failed)
+    return failed
+
 def run_cli():
     parser = argparse.ArgumentParser(description="TubeGo CLI v0.3")
-    parser.add_argument("url", help="URL del video (YouTube, X, etc.)")
+    parser.add_argument("url", nargs='?', help="URL del video (YouTube, X, etc.)")
     parser.add_argument("--type", choices=['video', 'audio'], default='video', help="Tipo de descarga (default: video)")
     parser.add_argument("--quality", choices=['best', 'max', '1080', '720', '480'], default='480', help="Calidad del video (default: 480)")
     parser.add_argument("-b", "--best", action="store_true", help="Descargar en la mejor calidad disponible (equivale a --quality best)")
-    
+    parser.add_argument("-i", "--input", metavar="ARCHIVO", help="Modo lote: archivo con una URL por línea ('-' para stdin). Salida en JSON-lines")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="Modo lote: descargas en paralelo (default: 2)")
+
     args = parser.parse_args()
-    
+    if not args.url and not args.input:
+        parser.error("indica una URL o un archivo de URLs con --input")
+    if args.jobs < 1:
+        parser.error("--jobs debe ser al menos 1")
+
     # Si el usuario elige audio, la calidad no importa, forzamos modo audio
     mode = args.type
     # Unificamos 'best', 'max' y el flag -b
     quality = 'max' if (args.best or args.quality == 'best' or args.quality == 'max') else args.quality
-    
-    print(f"Iniciando descarga de: {args.url}")
-    print(f"Modo: {mode} | Calidad: {quality if mode == 'video' else 'N/A (Audio)'}")
-    
-    downloader = Downloader()
-    result = downloader.download(args.url, mode=mode, quality=quality, progress_hook=progress_hook)
-    
-    if result['status'] == 'success':
-        print(f"\n¡Éxito! Archivo guardado en: {result['path']}")
-    else:
-        print(f"\nError: {result['message']}")
+
+    # Al salir (también con sys.exit) se cierran las instancias de yt-dlp del pool
+    try:
+        if args.input:
+            sys.exit(1 if run_batch(args.input, mode, quality, args.jobs) else 0)
+
+        print(f"Iniciando descarga de: {args.url}")
+        print(f"Modo: {mode} | Calidad: {quality if mode == 'video' else 'N/A (Audio)'}")
+
+        downloader = get_downloader()
+        progress_bus.subscribe(print_progress, interval=0.2, keys={'cli'})
+        result = downloader.download(args.url, mode=mode, quality=quality, progress_hook=progress_bus.hook('cli'))
+
+        if result['status'] == 'success':
+            print(f"\n¡Éxito! Archivo guardado en: {result['path']}")
+        else:
+            print(f"\nError: {result['message']}")
+    finally:
+        ydl_pool.close_all()
 
 if __name__ == "__main__":
-    run_cli()
\ No newline at end of file
+    run_cli()
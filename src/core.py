@@ -1,19 +1,560 @@
-import yt_dlp
 import os
 import shutil
+import copy
+import time
+import struct
+import subprocess
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, ExitStack
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Parámetros de seguimiento que no cambian el video al que apunta el enlace (en cualquier sitio)
+TRACKING_PARAMS = {'fbclid', 'gclid'}
+# Los genéricos ('s', 't'...) solo donde se sabe que son de seguimiento: en otros sitios pueden elegir el video
+SITE_TRACKING_PARAMS = {
+    'youtube.com': {'si', 'feature', 'pp', 't'},
+    'twitter.com': {'s', 't'},
+    'instagram.com': {'igshid', 'igsh'},
+}
+
+def normalize_url(url):
+    """Normaliza una URL para usarla como clave de cache (youtu.be, m., www., tracking...)"""
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+
+    host = (parts.hostname or '').lower()
+    for prefix in ('www.', 'm.', 'mobile.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path.rstrip('/')
+    query = parse_qsl(parts.query)
+
+    # Formas cortas de YouTube -> youtube.com/watch?v=ID
+    if host == 'youtu.be' and path:
+        query = [('v', path.lstrip('/'))] + query
+        host, path = 'youtube.com', '/watch'
+    elif host == 'youtube.com' and path.startswith('/shorts/'):
+        query = [('v', path[len('/shorts/'):])] + query
+        path = '/watch'
+    elif host == 'x.com':
+        host = 'twitter.com'
+
+    tracking = TRACKING_PARAMS | SITE_TRACKING_PARAMS.get(host, set())
+    query = [(k, v) for k, v in query if k not in tracking and not k.startswith('utm_')]
+
+    return urlunsplit(('https', host, path, urlencode(sorted(query)), ''))
+
+# Presupuesto de la calidad 'fast': el límite de subida de la Bot API
+FAST_SIZE_BUDGET = 50 * 1024 * 1024
+
+def estimate_format_size(fmt, duration=None):
+    """Tamaño esperado de un formato en bytes (filesize, filesize_approx o tbr * duración)"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration # tbr viene en kbit/s
+    return size
+
+def plan_format(info, budget, mode='video', allow_merge=True, margin=0.95):
+    """
+    Elige la mejor combinación de formatos (video+audio, o uno progresivo) cuyo
+    tamaño estimado cabe en `budget` bytes, a partir de los formatos ya extraídos.
+    Devuelve un format spec con IDs concretos ('137+140', '18') o None si no hay
+    tamaños conocidos o nada cabe (el llamador usa entonces su selección por altura).
+    """
+    duration = info.get('duration')
+    limit = budget * margin # Margen para el contenedor y para estimaciones por tbr
+    sized = [(f, estimate_format_size(f, duration)) for f in info.get('formats') or []]
+    sized = [(f, size) for f, size in sized if size and f.get('format_id')]
+
+    audios = [(f, size) for f, size in sized if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    # Preferimos m4a (se une sin problemas en MP4) y luego más bitrate
+    audios.sort(key=lambda x: (x[0].get('ext') == 'm4a', x[0].get('abr') or x[0].get('tbr') or 0), reverse=True)
+
+    if mode == 'audio':
+        fitting = [f for f, size in audios if size <= limit]
+        return fitting[0]['format_id'] if fitting else None
+
+    options = [] # (altura, compatible con mp4, tamaño, spec)
+    for f, size in sized:
+        if f.get('vcodec') in (None, 'none'):
+            continue
+        height = f.get('height') or 0
+        if f.get('acodec') not in (None, 'none'):
+            # Progresivo: video y audio en el mismo archivo
+            if size <= limit:
+                options.append((height, f.get('ext') == 'mp4', size, f['format_id']))
+        elif allow_merge:
+            for a, a_size in audios:
+                if size + a_size <= limit:
+                    compatible = f.get('ext') == 'mp4' and a.get('ext') == 'm4a'
+                    options.append((height, compatible, size + a_size, f"{f['format_id']}+{a['format_id']}"))
+                    break
+
+    if not options:
+        return None
+    return max(options)[3]
+
+def estimate_download_size(info, mode='video', quality='max'):
+    """
+    Tamaño aproximado de lo que descargará `quality` (el mejor video hasta esa altura
+    más el mejor audio), para reservar disco antes de empezar. None si no se sabe.
+    """
+    duration = info.get('duration')
+    sized = [(f, estimate_format_size(f, duration)) for f in info.get('formats') or []]
+    sized = [(f, size) for f, size in sized if size]
+    if not sized:
+        return info.get('filesize') or info.get('filesize_approx')
+
+    audios = [size for f, size in sized if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    audio = max(audios) if audios else 0
+    if mode == 'audio':
+        return audio or None
+
+    max_height = int(quality) if str(quality).isdigit() else (480 if quality == 'fast' else None)
+    videos = [(f.get('height') or 0, size, f.get('acodec') == 'none') for f, size in sized
+              if f.get('vcodec') not in (None, 'none') and (not max_height or (f.get('height') or 0) <= max_height)]
+    if not videos:
+        return None
+    height, size, video_only = max(videos)
+    size += audio if video_only else 0
+    return min(size, FAST_SIZE_BUDGET) if quality == 'fast' else size
+
+def is_playlist_url(url):
+    """True si la URL es una playlist o un canal (y no un video dentro de una playlist)"""
+    parts = urlsplit(normalize_url(url))
+    if parts.hostname == 'youtube.com':
+        return (parts.path == '/playlist'
+                or parts.path.startswith(('/@', '/channel/', '/c/', '/user/')))
+    return False
+
+class InfoCache:
+    """Cache LRU con expiración (TTL) de los info dicts extraídos por yt-dlp"""
+    def __init__(self, max_entries=64, ttl=1800):
+        # Las URLs de los formatos de YouTube caducan a las ~6h, así que el TTL
+        # se mantiene bastante por debajo para no reutilizar enlaces muertos.
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # { url_normalizada: (expira_en, info) }
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        """Devuelve una copia del info dict o None si no está o ha caducado"""
+        key = normalize_url(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # Copia: yt-dlp modifica el dict al procesarlo
+                return copy.deepcopy(entry[1])
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, url, info):
+        key = normalize_url(url)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(info))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, url):
+        with self.lock:
+            self.entries.pop(normalize_url(url), None)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+# Cache compartida por todos los Downloader del proceso
+info_cache = InfoCache()
+
+# Campos del video que no vienen del formato elegido y se conservan al reprocesar
+VIDEO_KEYS = {'id', 'title', 'fulltitle', 'duration', 'formats', 'thumbnail', 'thumbnails', 'description',
+              'uploader', 'extractor', 'extractor_key', 'webpage_url', 'original_url', '_format_sort_fields'}
+
+def reprocessable(info):
+    """
+    Info dict ya procesado (el de la cache) sin la selección de formato del análisis.
+    yt-dlp copia a la raíz los campos del formato elegido (requested_formats, format_id,
+    url, ext...); si se quedan, una selección nueva de un solo formato (p.ej. audio)
+    hereda los requested_formats anteriores y acaba descargando y uniendo el video.
+    """
+    selected = {'requested_formats', 'requested_downloads', 'requested_subtitles', 'format', 'format_id', 'format_note'}
+    for f in (info.get('formats') or []) + (info.get('requested_formats') or []):
+        selected.update(f)
+    return {k: v for k, v in info.items() if k not in selected - VIDEO_KEYS}
+
+class ProgressEvent(namedtuple('ProgressEvent', 'key phase downloaded total speed eta time')):
+    """
+    Progreso de una descarga, solo con números (bytes, bytes/s, segundos).
+    phase: 'downloading', 'processing' (merge/conversión), 'done' o 'error'.
+    """
+    __slots__ = ()
+
+    @property
+    def fraction(self):
+        """0.0 a 1.0, o None si no se conoce el total"""
+        if self.phase == 'done': return 1.0
+        if not self.total or self.downloaded is None: return None
+        return min(self.downloaded / self.total, 1.0)
+
+class ProgressSubscription:
+    """
+    Un consumidor del bus: recibe listas de eventos, como mucho una vez cada `interval` s.
+    Lo que se retiene dentro del intervalo lo entrega un timer, aunque no llegue nada más
+    (una descarga parada no deja el progreso congelado).
+    """
+    def __init__(self, callback, interval, keys=None):
+        self.callback = callback
+        self.interval = interval
+        self.keys = keys # None = todas las descargas
+        self.pending = {} # { key: último evento sin entregar } (coalescencia)
+        self.last_flush = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def _cancel_timer(self):
+        # Llamar con self.lock tomado
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def offer(self, event, urgent):
+        """Apunta el evento y devuelve los que tocan entregar ahora (o None)"""
+        with self.lock:
+            self.pending[event.key] = event
+            now = time.monotonic()
+            if not urgent and now - self.last_flush < self.interval:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.interval - (now - self.last_flush), self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return None
+            self.last_flush = now
+            self._cancel_timer()
+            events, self.pending = list(self.pending.values()), {}
+            return events
+
+    def flush(self):
+        """Entrega lo pendiente sin esperar al intervalo (lo llama el timer)"""
+        with self.lock:
+            self.timer = None
+            self.last_flush = time.monotonic()
+            events, self.pending = list(self.pending.values()), {}
+        if events:
+            try:
+                self.callback(events)
+            except Exception:
+                pass
+
+    def close(self):
+        with self.lock:
+            self._cancel_timer()
+            self.pending = {}
+
+class ProgressBus:
+    """
+    Canal único de progreso para CLI, GUI y bot. El hook de yt-dlp solo publica
+    números; cada consumidor se suscribe con su propio ritmo de refresco y recibe
+    el último estado de cada descarga (los ticks intermedios se descartan). Los
+    cambios de fase se entregan siempre en el momento.
+    """
+    def __init__(self):
+        self.latest = {} # { key: ProgressEvent }
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback, interval=1.0, keys=None):
+        sub = ProgressSubscription(callback, interval, keys)
+        with self.lock:
+            self.subscribers = [*self.subscribers, sub]
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not sub]
+        sub.close()
+
+    def publish(self, key, phase, downloaded=None, total=None, speed=None, eta=None):
+        event = ProgressEvent(key, phase, downloaded, total, speed, eta, time.monotonic())
+        with self.lock:
+            previous = self.latest.get(key)
+            if phase in ('done', 'error'):
+                self.latest.pop(key, None)
+            else:
+                self.latest[key] = event
+            subscribers = self.subscribers
+        urgent = previous is None or previous.phase != phase
+        for sub in subscribers:
+            if sub.keys is not None and key not in sub.keys: continue
+            events = sub.offer(event, urgent)
+            if events:
+                try:
+                    sub.callback(events)
+                except Exception:
+                    pass # Un consumidor roto no debe cortar la descarga
+
+    def hook(self, key):
+        """Hook de yt-dlp que publica el progreso de `key` en el bus"""
+        def hook(d):
+            if d['status'] == 'downloading':
+                self.publish(key, 'downloading', d.get('downloaded_bytes'),
+                             d.get('total_bytes') or d.get('total_bytes_estimate'),
+                             d.get('speed'), d.get('eta'))
+            elif d['status'] == 'finished':
+                self.publish(key, 'processing', d.get('downloaded_bytes'), d.get('total_bytes'))
+        return hook
+
+    def get(self, key):
+        with self.lock:
+            return self.latest.get(key)
+
+# Bus compartido por todos los frontends del proceso
+progress_bus = ProgressBus()
+
+_pooled_ydl_class = None
+
+def pooled_ydl_class():
+    """
+    Clase YoutubeDL del pool. yt_dlp (y con él sus extractores) se importa aquí, en el
+    primer uso, para no pagarlo al arrancar el bot, la interfaz o el `--help` del CLI.
+    """
+    global _pooled_ydl_class
+    if _pooled_ydl_class is None:
+        import yt_dlp
+
+        class PooledYDL(yt_dlp.YoutubeDL):
+            """
+            YoutubeDL del pool. Si `deferred` es una lista, el post-procesado (merge, MP3...)
+            no se ejecuta al terminar la descarga: se apunta ahí para la etapa de ffmpeg.
+            """
+            deferred = None
+
+            def post_process(self, filename, info, files_to_move=None):
+                if self.deferred is None or not (info.get('__postprocessors') or self._pps['post_process']):
+                    return super().post_process(filename, info, files_to_move)
+                info['filepath'] = filename
+                self.deferred.append((filename, info, files_to_move))
+                return info
+
+        _pooled_ydl_class = PooledYDL
+    return _pooled_ydl_class
+
+class YDLPool:
+    """
+    Pool de instancias YoutubeDL ya inicializadas, agrupadas por perfil de opciones.
+    Cada instancia conserva sus extractores cargados, su sesión HTTP y su cookie jar,
+    así que los trabajos siguientes se ahorran la inicialización y los handshakes.
+    Una instancia YoutubeDL no es thread-safe: se presta a un solo trabajo a la vez.
+    """
+    def __init__(self, max_idle_per_profile=4):
+        self.max_idle_per_profile = max_idle_per_profile
+        self.idle = {} # { perfil: [ydl, ...] }
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    @staticmethod
+    def profile_key(opts):
+        return repr(sorted(opts.items()))
+
+    @contextmanager
+    def checkout(self, opts, progress_hooks=(), overrides=None):
+        """
+        Presta una instancia para el perfil `opts`. Los hooks de progreso, los
+        `overrides` (parámetros que yt-dlp lee en cada descarga) y un format_selector
+        cambiado durante el trabajo se restauran al devolverla.
+        """
+        key = self.profile_key(opts)
+        with self.lock:
+            bucket = self.idle.get(key)
+            ydl = bucket.pop() if bucket else None
+            if ydl is None:
+                self.created += 1
+            else:
+                self.reused += 1
+
+        if ydl is None:
+            ydl = pooled_ydl_class()(copy.deepcopy(opts))
+
+        saved = {k: ydl.params.get(k) for k in (overrides or {})}
+        format_selector = ydl.format_selector
+        ydl.params.update(overrides or {})
+        ydl._progress_hooks = list(progress_hooks)
+        try:
+            yield ydl
+        finally:
+            ydl._progress_hooks = []
+            ydl.deferred = None
+            ydl.format_selector = format_selector
+            ydl.params.update(saved)
+            ydl._download_retcode = 0
+            with self.lock:
+                bucket = self.idle.setdefault(key, [])
+                if len(bucket) < self.max_idle_per_profile:
+                    bucket.append(ydl)
+                    ydl = None
+            if ydl is not None:
+                ydl.close()
+
+    def stats(self):
+        with self.lock:
+            idle = sum(len(b) for b in self.idle.values())
+            return {'created': self.created, 'reused': self.reused, 'idle': idle, 'profiles': len(self.idle)}
+
+    def close_all(self):
+        """Cierra las instancias libres (guarda cookies y cierra conexiones)"""
+        with self.lock:
+            buckets, self.idle = self.idle, {}
+        for bucket in buckets.values():
+            for ydl in bucket:
+                ydl.close()
+
+# Pool compartido por todo el proceso
+ydl_pool = YDLPool()
+
+class FragmentTuner:
+    """
+    Decide cuántos fragmentos DASH/HLS baja cada tarea en paralelo, midiendo el
+    throughput de cada una y repartiendo un tope global entre todas las tareas.
+    yt-dlp lee `concurrent_fragment_downloads` al empezar cada stream, así que el
+    ajuste se aplica en el siguiente stream (p.ej. el audio tras el video) y lo
+    aprendido por sitio se usa como punto de partida para las tareas siguientes.
+    """
+    def __init__(self, global_cap=16, max_per_task=8, initial=2):
+        self.global_cap = global_cap
+        self.max_per_task = max_per_task
+        self.initial = initial
+        self.tasks = {} # { task_key: {'n', 'site', 'speeds', 'prev'} }
+        self.learned = {} # { extractor: n }
+        self.lock = threading.Lock()
+
+    def _free(self):
+        return self.global_cap - sum(t['n'] for t in self.tasks.values())
+
+    def acquire(self, key, site=None):
+        """Registra la tarea y devuelve su concurrencia inicial (siempre al menos 1)"""
+        with self.lock:
+            wanted = self.learned.get(site, self.initial)
+            n = max(1, min(wanted, self.max_per_task, self._free()))
+            self.tasks[key] = {'n': n, 'site': site, 'speeds': [], 'prev': None}
+            return n
+
+    def report(self, key, speed):
+        """Anota una muestra de velocidad (bytes/s) del stream en curso"""
+        if not speed:
+            return
+        with self.lock:
+            task = self.tasks.get(key)
+            if task:
+                task['speeds'].append(speed)
+                del task['speeds'][:-20]
+
+    def adjust(self, key):
+        """
+        Al terminar un stream: si doblar la concurrencia anterior mejoró el
+        throughput se vuelve a subir, si lo empeoró se vuelve atrás.
+        """
+        with self.lock:
+            task = self.tasks.get(key)
+            if not task:
+                return 1
+            if not task['speeds']:
+                return task['n']
+
+            speed = sum(task['speeds']) / len(task['speeds'])
+            task['speeds'] = []
+            n, prev = task['n'], task['prev']
+            if prev is None or speed > prev[1] * 1.15:
+                target = min(n * 2, self.max_per_task, n + self._free())
+            elif speed < prev[1] * 0.9:
+                target = prev[0]
+            else:
+                target = n
+            task['prev'] = (n, speed)
+            task['n'] = max(1, target)
+            return task['n']
+
+    def release(self, key):
+        with self.lock:
+            task = self.tasks.pop(key, None)
+            if task and task['site']:
+                self.learned[task['site']] = task['n']
+
+    def snapshot(self):
+        """{ task_key: fragmentos en paralelo } de las tareas activas"""
+        with self.lock:
+            return {k: t['n'] for k, t in self.tasks.items()}
+
+# Opciones del perfil de análisis (solo extracción)
+INFO_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'skip_download': True, # Crucial: No descargar
+    'noplaylist': True, # watch?v=X&list=Y es el video X; las playlists van por iter_playlist
+}
+
+# Perfil para expandir playlists sin extraer cada video
+PLAYLIST_OPTS = {
+    **INFO_OPTS,
+    'noplaylist': False,
+    'extract_flat': 'in_playlist',
+    'lazy_playlist': True,
+}
+
+# Contenedores MP4/ISO-BMFF en los que el índice (moov) puede quedar al final
+FAST_START_EXTS = ('.mp4', '.m4v', '.m4a', '.mov')
+
+def moov_after_mdat(path):
+    """
+    True si el átomo moov va detrás de los datos (mdat): el reproductor tiene que
+    bajarse casi todo el archivo antes de empezar. Solo lee las cabeceras de primer nivel.
+    """
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8: return False
+                size, kind = struct.unpack('>I4s', header)
+                if kind == b'moov': return False
+                if kind == b'mdat': return True
+                if size == 1: # Tamaño de 64 bits
+                    size = struct.unpack('>Q', f.read(8))[0] - 8
+                elif size == 0: # Hasta el final del archivo
+                    return False
+                if size < 8: return False
+                f.seek(size - 8, os.SEEK_CUR)
+    except OSError:
+        return False
 
 class Downloader:
-    def __init__(self, download_dir="downloads"):
+    def __init__(self, download_dir="downloads", fast_start=True):
         self.download_dir = download_dir
         if not os.path.exists(self.download_dir):
             os.makedirs(self.download_dir)
         
         # Detectar si tenemos ffmpeg (Generalmente SI en PC, NO en Android)
         self.has_ffmpeg = shutil.which('ffmpeg') is not None
+        # Fast-start: moov al principio para que Telegram reproduzca mientras descarga
+        self.fast_start = fast_start and self.has_ffmpeg
+
+    def get_format_string(self, mode, quality, single_file=False):
+        # 'fast' se planifica por tamaño en download(); si no hay tamaños, 480p
+        if quality == 'fast':
+            quality = '480'
 
-    def get_format_string(self, mode, quality):
         # --- MODO SIN FFMPEG (ANDROID / LIGHT) ---
-        if not self.has_ffmpeg:
+        # single_file: un único stream que se escribe tal cual al disco (sin merge ni
+        # conversión), necesario para subir el archivo mientras se descarga.
+        if not self.has_ffmpeg or single_file:
             if mode == 'audio':
                 # Descargar audio nativo (m4a/aac) que Android lee bien sin convertir
                 return 'bestaudio[ext=m4a]/bestaudio'
@@ -36,55 +577,115 @@ class Downloader:
         
         return f'bestvideo[height<={quality}][ext=mp4]+bestaudio[ext=m4a]/best[height<={quality}][ext=mp4]/best'
 
+    def get_format_key(self, mode, quality, single_file=False):
+        """Identifica la selección de formato (incluye si habrá conversión a MP3)"""
+        if quality == 'fast':
+            return f"{mode}/fast<{FAST_SIZE_BUDGET}>/{'single' if single_file or not self.has_ffmpeg else 'merge'}"
+        return f"{mode}/{self.get_format_string(mode, quality, single_file)}"
+
+    def extract_info(self, url, ydl=None):
+        """Devuelve el info dict de la URL, usando la cache si está disponible"""
+        info = info_cache.get(url)
+        if info is None:
+            info = self._extract_fresh(url, ydl)
+        return info
+
+    def _extract_fresh(self, url, ydl=None):
+        """Extrae el info dict con yt-dlp (sin descargar) y lo guarda en la cache"""
+        if ydl is None:
+            with ydl_pool.checkout(INFO_OPTS) as ydl:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        else:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+        info_cache.put(url, info)
+        return info
+
     def get_video_info(self, url):
         """Extrae metadatos del video sin descargarlo"""
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'skip_download': True, # Crucial: No descargar
-        }
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                return {
-                    "status": "success",
-                    "title": info.get('title', 'Desconocido'),
-                    "duration": info.get('duration_string', 'N/A'),
-                    "uploader": info.get('uploader', 'Desconocido'),
-                    "thumbnail": info.get('thumbnail', None)
-                }
+            info = self.extract_info(url)
+            return {
+                "status": "success",
+                "title": info.get('title', 'Desconocido'),
+                "duration": info.get('duration_string', 'N/A'),
+                "uploader": info.get('uploader', 'Desconocido'),
+                "thumbnail": info.get('thumbnail', None)
+            }
         except Exception as e:
             return {"status": "error", "message": str(e)}
 
-    def download(self, url, mode='video', quality='720', progress_hook=None, check_cancel=None):
+    def iter_playlist(self, url):
+        """
+        Generador perezoso de las entradas de una playlist o canal: las páginas se
+        piden a medida que se consumen y los videos no se extraen aquí.
+        """
+        with ydl_pool.checkout(PLAYLIST_OPTS) as ydl:
+            result = ydl.extract_info(url, download=False, process=False)
+            if result.get('_type', 'video') == 'video':
+                yield {'url': url, 'id': result.get('id'), 'title': result.get('title')}
+                return
+
+            for entry in result.get('entries') or []:
+                if not entry:
+                    continue
+                entry_url = entry.get('url') or entry.get('webpage_url')
+                if not entry_url:
+                    continue
+                # Un canal puede devolver sus pestañas (Videos, Shorts...) como sub-playlists
+                if entry.get('_type') == 'playlist' or is_playlist_url(entry_url):
+                    yield from self.iter_playlist(entry_url)
+                    continue
+                yield {'url': entry_url, 'id': entry.get('id'), 'title': entry.get('title')}
+
+    def download(self, url, mode='video', quality='720', progress_hook=None, check_cancel=None,
+                 fragment_tuner=None, task_key=None, single_file=False, defer_postprocessing=False,
+                 bandwidth=None, priority='normal'):
         """
         Descarga inteligente adaptada a la presencia de FFMPEG.
         Permite cancelación mediante el callback check_cancel.
+        Con fragment_tuner, la concurrencia de fragmentos DASH/HLS se ajusta sola.
+        Con single_file, el archivo final es exactamente el que se escribe durante la
+        descarga (sin merge, conversión ni fixups), para poder leerlo mientras crece.
+        Con defer_postprocessing, si queda merge/conversión (o el remux fast-start)
+        pendiente se devuelve {'status': 'downloaded', 'pending': ...} para terminarlo
+        con postprocess().
+        Con bandwidth (BandwidthScheduler), el 'ratelimit' de yt-dlp sigue la parte del
+        presupuesto de bajada que le toca a la tarea según su prioridad.
         """
-        
+        active = {} # ydl prestado, para ajustar la concurrencia entre streams
+
         # Wrapper para el hook que verifica cancelación
         def internal_hook(d):
             if check_cancel and check_cancel():
                 raise Exception("CANCELLED_BY_USER")
+            if fragment_tuner and 'ydl' in active:
+                if d['status'] == 'downloading' and d.get('fragment_count'):
+                    fragment_tuner.report(task_key, d.get('speed'))
+                elif d['status'] == 'finished':
+                    active['ydl'].params['concurrent_fragment_downloads'] = fragment_tuner.adjust(task_key)
             if progress_hook:
                 progress_hook(d)
 
+        # Los hooks no forman parte del perfil: se asignan al prestar la instancia del pool
         ydl_opts = {
             # Limitamos el titulo a 100 caracteres para evitar errores en sistemas de archivos
             # Especialmente util para X/Twitter donde el titulo es el contenido del tweet
             'outtmpl': os.path.join(self.download_dir, '%(title).100s.%(ext)s'),
-            'progress_hooks': [internal_hook],
             'quiet': True,
             'no_warnings': True,
             'restrictfilenames': True, # Evita caracteres especiales
+            'noplaylist': True,
         }
 
-        fmt = self.get_format_string(mode, quality)
-        ydl_opts['format'] = fmt
+        fmt = self.get_format_string(mode, quality, single_file)
         ydl_opts['format'] = fmt
 
         # Solo configuramos post-procesadores si existe FFMPEG
-        if self.has_ffmpeg:
+        if single_file:
+            # Un fixup reescribiría el archivo después de haberlo subido
+            ydl_opts['fixup'] = 'never'
+        elif self.has_ffmpeg:
             if mode == 'audio':
                 ydl_opts['postprocessors'] = [{
                     'key': 'FFmpegExtractAudio',
@@ -94,29 +695,327 @@ class Downloader:
             else:
                 # En video, merge_output_format requiere ffmpeg
                 ydl_opts['merge_output_format'] = 'mp4'
+                if self.fast_start:
+                    # El fast-start va en el mismo ffmpeg del merge: el archivo no se reescribe otra vez
+                    # (las versiones recientes de yt-dlp ya lo añaden; repetirlo no cambia nada)
+                    ydl_opts['postprocessor_args'] = {'merger+ffmpeg_o': ['-movflags', '+faststart']}
         else:
             # Ajustes para móvil/sin ffmpeg
             # No forzamos merge ni conversión.
             pass
 
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
+            overrides = {'concurrent_fragment_downloads': 1, 'ratelimit': None}
+            with ExitStack() as stack:
+                ydl = stack.enter_context(ydl_pool.checkout(ydl_opts, progress_hooks=[internal_hook], overrides=overrides))
+                # Reutilizamos la extracción del análisis (o de un intento anterior)
+                # y pasamos directamente al procesado/descarga de yt-dlp.
+                info = info_cache.get(url)
+                cached = info is not None
+                if not cached:
+                    info = self._extract_fresh(url, ydl)
+
+                if fragment_tuner:
+                    ydl.params['concurrent_fragment_downloads'] = fragment_tuner.acquire(
+                        task_key, info.get('extractor_key'))
+                    active['ydl'] = ydl
+                if bandwidth:
+                    def apply_rate(rate):
+                        # yt-dlp lee 'ratelimit' en cada bloque, así que el cambio es inmediato.
+                        # Con fragmentos en paralelo cada hilo lo aplica por separado.
+                        threads = ydl.params.get('concurrent_fragment_downloads') or 1
+                        ydl.params['ratelimit'] = rate / threads if rate else None
+                    bandwidth.join('down', task_key, priority, apply_rate)
+                    # Se sale del reparto antes de devolver la instancia al pool
+                    stack.callback(bandwidth.leave, 'down', task_key)
+                if quality == 'fast':
+                    # Mejor combinación que cabe en la Bot API según los tamaños ya extraídos
+                    planned = plan_format(info, FAST_SIZE_BUDGET, mode, allow_merge=self.has_ffmpeg and not single_file)
+                    if planned:
+                        ydl.format_selector = ydl.build_format_selector(planned)
+                if defer_postprocessing:
+                    ydl.deferred = []
+                try:
+                    info = ydl.process_ie_result(reprocessable(info), download=True)
+                except Exception as e:
+                    # Si la info venía de cache, las URLs de los formatos pueden haber
+                    # caducado: repetimos una vez con una extracción limpia.
+                    if not cached or 'CANCELLED_BY_USER' in str(e):
+                        raise
+                    info_cache.invalidate(url)
+                    info = ydl.process_ie_result(reprocessable(self._extract_fresh(url, ydl)), download=True)
                 
+                # Los bytes ya están en disco: el merge/conversión lo hará la etapa de ffmpeg
+                if ydl.deferred:
+                    return {
+                        "status": "downloaded",
+                        "title": info.get('title', 'Unknown'),
+                        "pending": (ydl_opts, ydl.deferred, None),
+                        "ffmpeg_used": self.has_ffmpeg
+                    }
+
                 # Si estamos en modo audio sin ffmpeg, el archivo será .m4a
                 # Si estamos en modo audio con ffmpeg, será .mp3
-                
-                return {
-                    "status": "success", 
+
+                result = {
+                    "status": "success",
                     "title": info.get('title', 'Unknown'),
-                    "path": ydl.prepare_filename(info),
+                    "path": self._final_path(ydl, info),
                     "ffmpeg_used": self.has_ffmpeg
                 }
+            # Sin merge no pasó por ffmpeg: si el moov quedó al final hay que remuxear.
+            # single_file no se toca (puede estar subiéndose ya)
+            if single_file or not self.needs_fast_start(result['path']):
+                return result
+            if defer_postprocessing:
+                return {**result, "status": "downloaded", "pending": (ydl_opts, [], result)}
+            self.make_fast_start(result['path'])
+            return result
         except Exception as e:
             return {"status": "error", "message": str(e)}
+        finally:
+            if fragment_tuner:
+                fragment_tuner.release(task_key)
+
+    def postprocess(self, pending):
+        """
+        Etapa de post-procesado: ejecuta el merge/conversión que download() aplazó y,
+        si el resultado aún tiene el moov al final, el remux fast-start.
+        """
+        ydl_opts, jobs, result = pending
+        try:
+            if jobs:
+                with ydl_pool.checkout(ydl_opts) as ydl:
+                    for filename, info, files_to_move in jobs:
+                        # Los post-procesadores del merge quedaron ligados a la instancia de la descarga
+                        for pp in info.get('__postprocessors') or []:
+                            pp.set_downloader(ydl)
+                        info = ydl.post_process(filename, info, files_to_move)
+                result = {
+                    "status": "success",
+                    "title": info.get('title', 'Unknown'),
+                    "path": info['filepath'],
+                    "ffmpeg_used": self.has_ffmpeg
+                }
+            if self.needs_fast_start(result['path']):
+                self.make_fast_start(result['path'])
+            return result
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+
+    def needs_fast_start(self, path):
+        return self.fast_start and path.lower().endswith(FAST_START_EXTS) and moov_after_mdat(path)
+
+    def make_fast_start(self, path):
+        """
+        Remux sin recodificar (-c copy) que mueve el moov al principio. Si ffmpeg
+        falla se queda el archivo original, que sigue siendo válido.
+        """
+        root, ext = os.path.splitext(path)
+        tmp = f"{root}.faststart{ext}"
+        try:
+            proc = subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', path, '-map', '0', '-c', 'copy',
+                                   '-movflags', '+faststart', tmp], capture_output=True)
+        except OSError:
+            return False
+        if proc.returncode == 0 and os.path.exists(tmp):
+            os.replace(tmp, path)
+            return True
+        if os.path.exists(tmp): os.remove(tmp)
+        return False
+
+    @staticmethod
+    def probe_duration(path):
+        """Duración en segundos según ffprobe, o None"""
+        try:
+            proc = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                                   '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                                  capture_output=True, text=True)
+            return float(proc.stdout.strip())
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def segment_path(path, number):
+        """Ruta de la parte `number` (desde 1) de `path`"""
+        root, ext = os.path.splitext(path)
+        return f"{root}.part{number:03d}{ext}"
+
+    def iter_segments(self, path, max_bytes=None, max_seconds=None, poll_interval=0.5):
+        """
+        Corta `path` en partes sin recodificar (-c copy), en keyframes, de como mucho
+        `max_seconds` y con un tamaño objetivo de `max_bytes` (se convierte a duración
+        con el bitrate medio; un GOP largo puede pasarse un poco). Genera las rutas en
+        orden según ffmpeg las va cerrando: una parte está lista cuando aparece la
+        siguiente o ffmpeg termina. Cerrar el generador detiene ffmpeg.
+        """
+        seconds = max_seconds
+        if max_bytes:
+            duration = self.probe_duration(path)
+            if not duration:
+                raise IOError("Cannot read the duration to split the file")
+            # Margen del 10% para los cortes en keyframe y los picos de bitrate
+            by_size = duration * max_bytes * 0.9 / os.path.getsize(path)
+            seconds = min(seconds, by_size) if seconds else by_size
+        if not seconds:
+            raise ValueError("max_bytes or max_seconds is required")
+
+        root, ext = os.path.splitext(path)
+        part_path = lambda n: self.segment_path(path, n)
+        # Patrón de ffmpeg: un '%' del título (restrictfilenames lo deja) iría como formato
+        pattern = f"{root.replace('%', '%%')}.part%03d{ext.replace('%', '%%')}"
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', path, '-map', '0', '-c', 'copy',
+               '-f', 'segment', '-segment_time', f"{seconds:.3f}", '-segment_start_number', '1',
+               '-reset_timestamps', '1']
+        if ext.lower() in FAST_START_EXTS:
+            cmd += ['-segment_format_options', 'movflags=+faststart']
+        proc = subprocess.Popen(cmd + [pattern], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        number = 1
+        try:
+            while True:
+                part = part_path(number)
+                # La parte siguiente ya existe: ffmpeg cerró esta
+                if os.path.exists(part_path(number + 1)):
+                    yield part
+                    number += 1
+                    continue
+                if proc.poll() is not None:
+                    if proc.returncode != 0:
+                        lines = proc.stderr.read().decode(errors='replace').strip().splitlines()
+                        raise IOError(lines[-1] if lines else "ffmpeg failed")
+                    if os.path.exists(part):
+                        yield part
+                    return
+                time.sleep(poll_interval)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stderr.close()
+
+    @staticmethod
+    def _final_path(ydl, info):
+        """Ruta del archivo final (tras merge o conversión a MP3)"""
+        downloads = info.get('requested_downloads') or []
+        if downloads and downloads[-1].get('filepath'):
+            return downloads[-1]['filepath']
+        return ydl.prepare_filename(info)
 
     def list_downloads(self):
         try:
             return [f for f in os.listdir(self.download_dir) if os.path.isfile(os.path.join(self.download_dir, f))]
         except:
             return []
+
+class GrowingFile:
+    """
+    Lector de un archivo que yt-dlp todavía está escribiendo.
+    read() espera a que haya bytes suficientes y solo devuelve menos de lo pedido
+    cuando el escritor ya cerró (finish) el archivo. Si la descarga falla (fail),
+    read() lanza IOError.
+    """
+    def __init__(self, poll_interval=0.2):
+        self.poll_interval = poll_interval
+        self.paths = None # (ruta .part, ruta final)
+        self.fh = None
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.ready_callbacks = []
+
+    def _settled(self):
+        # Llamar con self.cond tomado
+        return bool(self.paths or self.closed or self.error)
+
+    def _notify(self):
+        # Llamar con self.cond tomado; devuelve los callbacks de on_ready a ejecutar (fuera del lock)
+        self.cond.notify_all()
+        callbacks, self.ready_callbacks = self.ready_callbacks, []
+        return callbacks
+
+    def attach(self, tmp_path, final_path=None):
+        """Se llama desde el hook de progreso en cuanto yt-dlp empieza a escribir"""
+        with self.cond:
+            if self.paths is not None: return
+            self.paths = (tmp_path, final_path or tmp_path)
+            callbacks = self._notify()
+        for callback in callbacks: callback()
+
+    @property
+    def ready(self):
+        """True si empezó la escritura; False si la descarga acabó sin escribir aquí"""
+        with self.cond:
+            return self.paths is not None and self.error is None
+
+    def wait_ready(self, timeout=None):
+        """Espera a que empiece la escritura. False si la descarga acabó sin escribir aquí"""
+        with self.cond:
+            self.cond.wait_for(self._settled, timeout)
+        return self.ready
+
+    def on_ready(self, callback):
+        """Llama a callback() (una vez, desde el hilo que lo provoque) cuando wait_ready() dejaría de esperar"""
+        with self.cond:
+            if not self._settled():
+                self.ready_callbacks.append(callback)
+                return
+        callback()
+
+    def finish(self):
+        with self.cond:
+            self.closed = True
+            callbacks = self._notify()
+        for callback in callbacks: callback()
+
+    def fail(self, error):
+        with self.cond:
+            self.error = str(error)
+            callbacks = self._notify()
+        for callback in callbacks: callback()
+
+    def _open(self):
+        # Al terminar, yt-dlp renombra el .part: si llegamos tarde abrimos el final.
+        # Si ya lo teníamos abierto, el descriptor sigue siendo válido tras el rename.
+        for path in self.paths:
+            try:
+                self.fh = open(path, 'rb')
+                return
+            except FileNotFoundError:
+                continue
+        raise IOError(f"File not found: {self.paths[1]}")
+
+    def read(self, size):
+        if self.fh is None:
+            self._open()
+        buf = bytearray()
+        while len(buf) < size:
+            if self.error:
+                raise IOError(self.error)
+            closed = self.closed # Leer el flag ANTES de leer el archivo evita perder el final
+            chunk = self.fh.read(size - len(buf))
+            if chunk:
+                buf += chunk
+                continue
+            if closed:
+                break
+            with self.cond:
+                self.cond.wait(self.poll_interval)
+        return bytes(buf)
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+# --- SERVICIO COMPARTIDO ---
+_downloaders = {}
+_downloaders_lock = threading.Lock()
+
+def get_downloader(download_dir="downloads"):
+    """Devuelve el Downloader compartido del proceso para `download_dir` (se crea una sola vez)"""
+    with _downloaders_lock:
+        downloader = _downloaders.get(download_dir)
+        if downloader is None:
+            downloader = Downloader(download_dir)
+            _downloaders[download_dir] = downloader
+        return downloader
@@ -1,37 +1,801 @@
 import uuid
+import sys
+import hashlib
 import threading
 import os
 import shutil
-from src.core import Downloader
+import json
+import time
+import sqlite3
+import concurrent.futures
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlsplit
+from src.core import get_downloader, FragmentTuner, progress_bus, normalize_url, estimate_download_size
+
+class DownloadIndex:
+    """
+    Índice en disco de lo ya descargado: (extractor, id del video, formato) -> archivo.
+    Así youtu.be/X y youtube.com/watch?v=X (o x.com y twitter.com) apuntan al mismo archivo.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    @staticmethod
+    def make_key(extractor, video_id, format_key):
+        return f"{extractor}:{video_id}:{format_key}"
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def lookup(self, key):
+        """Ruta del archivo ya descargado, o None (las entradas sin archivo se purgan)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if os.path.exists(entry['path']):
+                return entry['path']
+            del self.entries[key]
+            self._save()
+            return None
+
+    def record(self, key, path):
+        with self.lock:
+            self.entries[key] = {'path': path, 'time': time.time()}
+            self._save()
+
+    def keys_for(self, path):
+        """Claves (extractor, id, formato) que apuntan a ese archivo"""
+        with self.lock:
+            return [k for k, e in self.entries.items() if e['path'] == path]
+
+    def move(self, src, dst):
+        """Actualiza las entradas de un archivo que se ha movido (p.ej. a 'uploaded')"""
+        with self.lock:
+            moved = [e for e in self.entries.values() if e['path'] == src]
+            for e in moved:
+                e['path'] = dst
+            if moved:
+                self._save()
+
+LocalFile = namedtuple('LocalFile', 'id name path size mtime')
+
+class FileIndex:
+    """
+    Índice de los archivos de una carpeta (sin subcarpetas) con IDs estables: el ID
+    sale del nombre, así que un botón sigue apuntando al mismo archivo aunque la
+    carpeta cambie. Solo se vuelve a leer la carpeta (scandir) cuando cambia su
+    mtime; las listas ordenadas se guardan hasta el siguiente cambio, así que una
+    página se saca con un slice.
+    """
+    SORTS = {
+        'name': (lambda f: f.name.lower(), False),
+        'size': (lambda f: f.size, True),
+        'date': (lambda f: f.mtime, True),
+    }
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.entries = {} # { id: LocalFile }
+        self.sorted = {} # { orden: [LocalFile, ...] }
+        self.stamp = None # mtime de la carpeta en la última lectura
+
+    @staticmethod
+    def make_id(name):
+        return hashlib.sha1(name.encode('utf-8', 'surrogateescape')).hexdigest()[:10]
+
+    def refresh(self):
+        """Relee la carpeta si cambió (crear, borrar o renombrar cambia su mtime)"""
+        try:
+            stamp = os.stat(self.folder).st_mtime_ns
+        except OSError:
+            stamp = None
+        with self.lock:
+            if stamp == self.stamp and stamp is not None: return False
+            entries = {}
+            try:
+                for entry in os.scandir(self.folder):
+                    if not entry.is_file(): continue
+                    st = entry.stat()
+                    file_id = self.make_id(entry.name)
+                    entries[file_id] = LocalFile(file_id, entry.name, entry.path, st.st_size, st.st_mtime)
+            except OSError:
+                pass
+            self.entries, self.sorted, self.stamp = entries, {}, stamp
+            return True
+
+    def get(self, file_id):
+        self.refresh()
+        with self.lock:
+            return self.entries.get(file_id)
+
+    def _sorted(self, sort):
+        # Llamar con self.lock tomado
+        if sort not in self.sorted:
+            key, reverse = self.SORTS[sort]
+            self.sorted[sort] = sorted(self.entries.values(), key=key, reverse=reverse)
+        return self.sorted[sort]
+
+    def listing(self, sort='name'):
+        self.refresh()
+        with self.lock:
+            return list(self._sorted(sort))
+
+    def page(self, number, per_page, sort='name'):
+        """(archivos de la página, página ajustada al rango, total de páginas, total de archivos)"""
+        self.refresh()
+        with self.lock:
+            files = self._sorted(sort)
+            pages = max(1, -(-len(files) // per_page))
+            number = min(max(number, 0), pages - 1)
+            shown = files[number * per_page:(number + 1) * per_page]
+        # Crecer no cambia el mtime de la carpeta: el tamaño de lo mostrado se lee al momento
+        return [self._restat(f) for f in shown], number, pages, len(files)
+
+    @staticmethod
+    def _restat(entry):
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            return entry
+        return entry._replace(size=st.st_size, mtime=st.st_mtime)
+
+class FileIdCache:
+    """
+    file_id de Telegram de lo ya enviado, para reenviarlo por referencia sin volver
+    a subir los bytes. Cada entrada se guarda bajo varias claves: el hash del
+    contenido ('sha256:...') y las del índice de descargas ('vid:extractor:id:formato').
+    Entrada: {'via': 'bot', 'kind': 'video'|'document', 'file_id': ...} o
+    {'via': 'userbot', 'document': [id, access_hash, file_reference en hex]}.
+    """
+    def __init__(self, path, max_entries=5000):
+        self.path = path
+        self.hashes_path = os.path.join(os.path.dirname(path), 'file_hashes.json')
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = self._load(self.path)
+        # { "dispositivo:inodo:tamaño:mtime": hash }, sobrevive a moverlo a 'uploaded' y a los reinicios
+        self.hashes = self._load(self.hashes_path)
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _dump(path, data):
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _save(self):
+        self._dump(self.path, self.entries)
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def content_hash(self, path):
+        """SHA-256 del archivo (se calcula una vez por archivo; es lento con archivos grandes)"""
+        stamp = self._stamp(path)
+        with self.lock:
+            if stamp in self.hashes: return self.hashes[stamp]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.hashes[stamp] = digest.hexdigest()
+            # Se descartan los más antiguos (los dict conservan el orden de inserción)
+            for old in list(self.hashes)[:len(self.hashes) - self.max_entries]:
+                del self.hashes[old]
+            self._dump(self.hashes_path, self.hashes)
+        return digest.hexdigest()
+
+    def cached_hash(self, path):
+        """Hash ya calculado del archivo, o None (no lee el archivo)"""
+        try:
+            stamp = self._stamp(path)
+        except OSError:
+            return None
+        with self.lock:
+            return self.hashes.get(stamp)
+
+    def lookup(self, keys):
+        """Primera entrada guardada bajo alguna de las claves, o None"""
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    return dict(self.entries[key])
+        return None
+
+    def record(self, keys, entry):
+        with self.lock:
+            for key in keys:
+                self.entries[key] = {**entry, 'time': time.time()}
+            # Se descartan las más antiguas
+            if len(self.entries) > self.max_entries:
+                for key in sorted(self.entries, key=lambda k: self.entries[k]['time'])[:len(self.entries) - self.max_entries]:
+                    del self.entries[key]
+            self._save()
+
+    def forget(self, keys):
+        """Borra una referencia caducada (Telegram ya no acepta ese file_id)"""
+        with self.lock:
+            if any([self.entries.pop(key, None) for key in keys]):
+                self._save()
+
+class TaskStore:
+    """
+    Historial de tareas en SQLite (modo WAL): sobrevive a los reinicios y se consulta
+    por estado o fecha con índices. Las tareas vivas siguen en memoria; aquí se
+    escriben por lotes, y solo las filas que cambiaron desde la última escritura.
+    """
+    FIELDS = ('id', 'url', 'status', 'progress', 'filename', 'file_path', 'last_error',
+              'mode', 'quality', 'single_file', 'part_file', 'downloaded_bytes', 'total_bytes',
+              'chat_id', 'message_id', 'batch', 'priority', 'created', 'content_key', 'updated')
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.written = {} # { id: última fila escrita }
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY, url TEXT, status TEXT, progress TEXT, filename TEXT,
+                file_path TEXT, last_error TEXT, mode TEXT, quality TEXT, single_file INTEGER,
+                part_file TEXT, downloaded_bytes INTEGER, total_bytes INTEGER, chat_id INTEGER,
+                message_id INTEGER, batch INTEGER, priority TEXT, created REAL, content_key TEXT,
+                updated REAL)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, created)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created)")
+
+    def _row(self, task):
+        return tuple(int(task.get(k) or 0) if k in ('single_file', 'batch') else task.get(k)
+                     for k in self.FIELDS[:-1])
+
+    def save(self, tasks):
+        """Upsert en una sola transacción de las tareas que cambiaron"""
+        now = time.time()
+        with self.lock:
+            changed = []
+            for task in tasks:
+                row = self._row(task)
+                if self.written.get(row[0]) != row:
+                    self.written[row[0]] = row
+                    changed.append((*row, now))
+            if not changed: return
+            placeholders = ", ".join("?" * len(self.FIELDS))
+            updates = ", ".join(f"{k}=excluded.{k}" for k in self.FIELDS[1:])
+            with self.db:
+                self.db.executemany(
+                    f"INSERT INTO tasks VALUES ({placeholders}) ON CONFLICT(id) DO UPDATE SET {updates}", changed)
+
+    def forget(self, task_ids):
+        """Olvida la última fila escrita de tareas que salen de memoria (ya están en la base)"""
+        with self.lock:
+            for task_id in task_ids:
+                self.written.pop(task_id, None)
+
+    def get(self, task_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return dict(row) if row else None
+
+    def by_status(self, statuses, limit=None):
+        """Tareas con alguno de esos estados, de la más antigua a la más nueva"""
+        query = f"SELECT * FROM tasks WHERE status IN ({', '.join('?' * len(statuses))}) ORDER BY created"
+        if limit: query += f" LIMIT {int(limit)}"
+        with self.lock:
+            return [dict(r) for r in self.db.execute(query, tuple(statuses))]
+
+    def set_status(self, statuses, status, error=None):
+        """Cambia de estado todas las tareas con alguno de esos estados"""
+        with self.lock, self.db:
+            self.db.execute(f"UPDATE tasks SET status = ?, last_error = COALESCE(?, last_error) "
+                            f"WHERE status IN ({', '.join('?' * len(statuses))})", (status, error, *statuses))
+            self.written.clear()
+
+    def delete(self, task_id):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+            self.written.pop(task_id, None)
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+class DiskQuota:
+    """
+    Cuota de disco de downloads/ y uploaded/. Lleva el total en uso al día (los
+    directorios solo se recorren al arrancar): cada archivo que entra, se mueve o se
+    borra pasa por aquí. Al superar `high` de `budget` bytes borra archivos ya
+    subidos, el menos usado primero, hasta bajar a `low`. Antes de cada descarga se
+    reserva su tamaño estimado; si no cabe ni liberando archivados, se rechaza.
+    budget=0: sin cuota, solo se vigila que queden `min_free` bytes libres en disco.
+    """
+    def __init__(self, base_dir, uploaded_dir, budget=0, high=0.9, low=0.75, min_free=512 * 1024 * 1024, pinned=None):
+        self.base_dir = base_dir
+        self.uploaded_dir = os.path.abspath(uploaded_dir)
+        self.budget = budget
+        self.high, self.low = high, low
+        self.min_free = min_free
+        self.pinned = pinned or (lambda: set()) # Rutas que no se pueden borrar (tareas en curso)
+        self.lock = threading.Lock()
+        self.files = {} # { ruta absoluta: tamaño }
+        self.archived = OrderedDict() # { ruta: None } de uploaded/, del menos al más usado
+        self.reserved = {} # { clave: bytes } de las descargas en curso
+        self.used = 0
+        self.evicted = 0
+        self._scan()
+
+    def _scan(self):
+        """Recorrido inicial (el único); los archivados se ordenan por fecha de modificación"""
+        archived = []
+        for folder in (self.base_dir, self.uploaded_dir):
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.is_file(): continue
+                st = entry.stat()
+                path = os.path.abspath(entry.path)
+                self.files[path] = st.st_size
+                if os.path.dirname(path) == self.uploaded_dir:
+                    archived.append((st.st_mtime, path))
+        self.used = sum(self.files.values())
+        for _, path in sorted(archived):
+            self.archived[path] = None
+
+    def add(self, path):
+        """Registra un archivo nuevo o que cambió de tamaño"""
+        path = os.path.abspath(path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            self.used += size - self.files.get(path, 0)
+            self.files[path] = size
+            if os.path.dirname(path) == self.uploaded_dir:
+                self.archived[path] = None
+                self.archived.move_to_end(path)
+
+    def discard(self, path):
+        """Quita de la cuenta un archivo borrado (o a punto de borrarse)"""
+        path = os.path.abspath(path)
+        with self.lock:
+            self.used -= self.files.pop(path, 0)
+            self.archived.pop(path, None)
+
+    def move(self, src, dst):
+        self.discard(src)
+        self.add(dst)
+
+    def touch(self, path):
+        """El archivo se ha vuelto a usar: pasa al final de la cola de desalojo"""
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.archived:
+                self.archived.move_to_end(path)
+
+    def _free_disk(self):
+        try:
+            return shutil.disk_usage(self.base_dir).free
+        except OSError:
+            return None
+
+    def _fits(self, size):
+        # Lo reservado aún no está escrito: cuenta contra la cuota y contra el disco libre
+        pending = sum(self.reserved.values()) + size
+        if self.budget and self.used + pending > self.budget:
+            return False
+        free = self._free_disk()
+        return free is None or free - pending >= self.min_free
+
+    def reserve(self, key, size):
+        """Reserva `size` bytes para una descarga, desalojando archivados si hace falta. False si no cabe"""
+        size = size or 0
+        pinned = self._pinned()
+        with self.lock:
+            while not self._fits(size):
+                if not self._evict_one(pinned):
+                    return False
+            self.reserved[key] = size
+            return True
+
+    def release(self, key, path=None):
+        """Fin de una descarga: se suelta la reserva, se cuenta el archivo final y se aplica la cuota"""
+        with self.lock:
+            self.reserved.pop(key, None)
+        if path:
+            self.add(path)
+        self.enforce()
+
+    def enforce(self):
+        """Por encima de la marca alta, desaloja archivados hasta la marca baja"""
+        if not self.budget: return 0
+        count = 0
+        pinned = self._pinned()
+        with self.lock:
+            if self.used <= self.budget * self.high: return 0
+            while self.used > self.budget * self.low and self._evict_one(pinned):
+                count += 1
+        return count
+
+    def _pinned(self):
+        # Fuera de self.lock: el callback toma el lock del manager
+        return {os.path.abspath(p) for p in self.pinned() if p}
+
+    def _evict_one(self, pinned):
+        """Borra el archivado menos usado que no esté en `pinned` (llamar con self.lock tomado)"""
+        for path in self.archived:
+            if path in pinned: continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            self.used -= self.files.pop(path, 0)
+            del self.archived[path]
+            self.evicted += 1
+            return True
+        return False
+
+    def snapshot(self):
+        with self.lock:
+            return {'used': self.used, 'budget': self.budget, 'reserved': sum(self.reserved.values()),
+                    'archived': len(self.archived), 'evicted': self.evicted, 'free': self._free_disk()}
+
+class BandwidthScheduler:
+    """
+    Reparte un presupuesto de bytes/s por dirección ('down', 'up') entre las tareas
+    activas según su prioridad. Cada tarea recibe su parte a través de un callback
+    (p.ej. el 'ratelimit' de yt-dlp) que se vuelve a llamar cuando cambian las tareas
+    o los presupuestos. Presupuesto 0 = sin límite.
+    """
+    PRIORITIES = {'low': 1, 'normal': 2, 'high': 4}
+
+    def __init__(self, down=0, up=0):
+        self.budgets = {'down': down, 'up': up}
+        self.tasks = {'down': {}, 'up': {}} # { dirección: { clave: [prioridad, callback] } }
+        self.lock = threading.Lock()
+
+    def join(self, direction, key, priority='normal', on_rate=None):
+        with self.lock:
+            self.tasks[direction][key] = [priority, on_rate]
+            self._rebalance(direction)
+
+    def leave(self, direction, key):
+        """Al volver, el callback de la tarea ya no se llamará más"""
+        with self.lock:
+            if self.tasks[direction].pop(key, None):
+                self._rebalance(direction)
+
+    def set_budget(self, direction, rate):
+        with self.lock:
+            self.budgets[direction] = max(0, rate)
+            self._rebalance(direction)
+
+    def set_priority(self, key, priority):
+        with self.lock:
+            found = False
+            for direction, tasks in self.tasks.items():
+                if key in tasks:
+                    tasks[key][0] = priority
+                    self._rebalance(direction)
+                    found = True
+            return found
+
+    def _share(self, direction, key):
+        budget = self.budgets[direction]
+        tasks = self.tasks[direction]
+        if not budget or key not in tasks: return None
+        total = sum(self.PRIORITIES.get(p, 2) for p, _ in tasks.values())
+        return budget * self.PRIORITIES.get(tasks[key][0], 2) / total
+
+    def _rebalance(self, direction):
+        # Con el lock tomado: así leave() garantiza que no hay llamadas posteriores.
+        # Los callbacks solo deben asignar un valor.
+        for key, (_, on_rate) in self.tasks[direction].items():
+            if on_rate: on_rate(self._share(direction, key))
+
+    def rate_for(self, direction, key):
+        """Bytes/s que le tocan ahora a la tarea (None = sin límite)"""
+        with self.lock:
+            return self._share(direction, key)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                direction: {'budget': self.budgets[direction],
+                            'tasks': {k: (p, self._share(direction, k)) for k, (p, _) in tasks.items()}}
+                for direction, tasks in self.tasks.items()
+            }
+
+def default_priority(mode, quality):
+    """Audio primero; 4K/máxima calidad por detrás para que no acapare el enlace"""
+    if mode == 'audio': return 'high'
+    if quality in ('best', 'max'): return 'low'
+    return 'normal'
+
+class TaskRecord:
+    """
+    Tarea en memoria. Los campos van en __slots__ (sin un dict por tarea) y el estado
+    sigue una máquina de estados: set_status() rechaza las transiciones no previstas
+    (p.ej. un tick de progreso tardío no pisa un 'cancelling'). Se accede como a un
+    dict (task['status'], task.get(...), task.update(...)) igual que antes.
+    """
+    FIELDS = ('id', 'url', 'status', 'progress', 'filename', 'file_path', 'cancel_flag',
+              'last_error', 'mode', 'quality', 'single_file', 'part_file', 'downloaded_bytes',
+              'total_bytes', 'speed', 'eta', 'chat_id', 'message_id', 'batch', 'priority',
+              'created', 'finished', 'content_key')
+    __slots__ = tuple('_status' if f == 'status' else f for f in FIELDS)
+
+    ACTIVE = ('queued', 'starting', 'downloading', 'processing', 'cancelling')
+    FINISHED = ('completed', 'cancelled', 'failed_dl', 'failed_ul')
+    TRANSITIONS = {
+        'starting': {'queued', 'downloading', 'processing', 'cancelling', 'cancelled', 'success', 'failed_dl', 'completed'},
+        'queued': {'starting', 'cancelling', 'cancelled', 'failed_dl'},
+        'downloading': {'processing', 'cancelling', 'cancelled', 'success', 'failed_dl', 'completed'},
+        'processing': {'downloading', 'cancelling', 'cancelled', 'success', 'failed_dl'},
+        'cancelling': {'cancelled', 'failed_dl'},
+        'interrupted': {'starting', 'queued', 'cancelled', 'failed_dl'}, # Nada en marcha: se cancela directamente
+        'success': {'starting', 'completed', 'failed_ul', 'failed_dl'}, # failed_dl: su file_id caducó y no hay archivo
+        'failed_ul': {'starting', 'completed'},
+        'failed_dl': {'starting', 'queued'},
+        'cancelled': {'starting', 'queued'},
+        'completed': set(),
+    }
+
+    def __init__(self, id, url, status='starting', **fields):
+        for f in self.__slots__:
+            setattr(self, f, None)
+        self.id, self.url, self._status = id, url, status
+        self.progress, self.cancel_flag = '0%', False
+        self.single_file = self.batch = False
+        self.downloaded_bytes = 0
+        self.created = time.time()
+        self.update(fields)
+        if status in self.FINISHED: self.finished = time.monotonic()
+
+    @property
+    def status(self):
+        return self._status
+
+    def set_status(self, status):
+        """Cambia de estado si la transición está permitida; devuelve si se cambió"""
+        if status != self._status and status not in self.TRANSITIONS.get(self._status, ()):
+            return False
+        self._status = status
+        self.finished = time.monotonic() if status in self.FINISHED else None
+        return True
+
+    # Acceso tipo dict
+    def __getitem__(self, key):
+        if key not in self.FIELDS: raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key == 'status': self.set_status(value)
+        elif key in self.FIELDS: setattr(self, key, value)
+        else: raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def keys(self):
+        return self.FIELDS
+
+    def update(self, other=(), **fields):
+        for key, value in dict(other, **fields).items():
+            self[key] = value
+
+    def footprint(self):
+        """Bytes aproximados en memoria (el registro y sus valores, sin compartidos como None)"""
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, f)) for f in self.__slots__
+                                         if isinstance(getattr(self, f), (str, int, float)) and not isinstance(getattr(self, f), bool))
+
+# Lo que queda en memoria de una tarea terminada tras sacarla (el resto está en el historial)
+TaskSummary = namedtuple('TaskSummary', 'id status filename')
+
+def site_of(url):
+    """Sitio de una URL para los topes por sitio (youtu.be, m.youtube.com... -> youtube.com)"""
+    return urlsplit(normalize_url(url)).hostname or ''
+
+class JobScheduler:
+    """
+    Cola acotada de descargas con prioridades. Corren como mucho `workers` trabajos a la
+    vez y, por sitio, lo que diga su tope (YouTube limita si se le abren muchas descargas).
+    Se arranca siempre el trabajo de más prioridad (y más antiguo) cuyo sitio tenga hueco.
+    Con la cola llena decide la política de admisión: 'reject' rechaza el trabajo nuevo y
+    'drop_lowest' expulsa al encolado de menor prioridad si el nuevo tiene más (y avisa
+    con on_drop(clave) para que su tarea no se quede 'queued').
+    """
+    SITE_CAPS = {'youtube.com': 2}
+
+    def __init__(self, workers=4, max_queue=50, site_caps=None, default_site_cap=3, policy='reject', on_drop=None):
+        self.workers = workers
+        self.on_drop = on_drop
+        self.max_queue = max_queue
+        self.site_caps = dict(self.SITE_CAPS, **(site_caps or {}))
+        self.default_site_cap = default_site_cap
+        self.policy = policy
+        self.queue = [] # [ trabajo ] en orden de llegada
+        self.running = {} # { sitio: trabajos en curso }
+        self.active = 0
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+
+    def site_group(self, site):
+        """music.youtube.com y youtube.com comparten tope"""
+        for name in self.site_caps:
+            if site == name or site.endswith('.' + name):
+                return name
+        return site
+
+    def cap_for(self, site):
+        return self.site_caps.get(site, self.default_site_cap)
+
+    @staticmethod
+    def _rank(job):
+        return (-BandwidthScheduler.PRIORITIES.get(job['priority'], 2), job['seq'])
+
+    def submit(self, key, fn, priority='normal', site=''):
+        """
+        Encola fn() para la tarea `key` y devuelve un Future con su resultado,
+        o None si la cola está llena y la política lo rechaza.
+        """
+        future = concurrent.futures.Future()
+        dropped = None
+        with self.lock:
+            self.seq += 1
+            job = {'key': key, 'fn': fn, 'priority': priority, 'site': self.site_group(site),
+                   'seq': self.seq, 'future': future}
+            if len(self.queue) >= self.max_queue:
+                if self.policy != 'drop_lowest': return None
+                dropped = max(self.queue, key=self._rank)
+                if self._rank(dropped) <= self._rank(job): return None
+                self.queue.remove(dropped)
+            self.queue.append(job)
+            self._dispatch()
+        if dropped:
+            result = {'status': 'error', 'message': 'Dropped from a full queue'}
+            if self.on_drop: result = self.on_drop(dropped['key'], result)
+            dropped['future'].set_result(result)
+        return future
+
+    def _dispatch(self):
+        # Con el lock tomado
+        for job in sorted(self.queue, key=self._rank):
+            if self.active >= self.workers: break
+            if self.running.get(job['site'], 0) >= self.cap_for(job['site']): continue
+            self.queue.remove(job)
+            self.active += 1
+            self.running[job['site']] = self.running.get(job['site'], 0) + 1
+            self.executor.submit(self._run, job)
+
+    def _run(self, job):
+        try:
+            job['future'].set_result(job['fn']())
+        except Exception as e:
+            job['future'].set_exception(e)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.running[job['site']] -= 1
+                self._dispatch()
+
+    def cancel(self, key):
+        """Saca de la cola un trabajo que aún no empezó"""
+        with self.lock:
+            job = next((j for j in self.queue if j['key'] == key), None)
+            if job: self.queue.remove(job)
+        if job:
+            job['future'].set_result({'status': 'cancelled', 'message': 'Cancelado por usuario'})
+        return job is not None
+
+    def set_priority(self, key, priority):
+        with self.lock:
+            for job in self.queue:
+                if job['key'] == key:
+                    job['priority'] = priority
+            self._dispatch()
+
+    def position(self, key):
+        """Puesto en la cola (1 = el siguiente en arrancar), o None si no está encolado"""
+        with self.lock:
+            for i, job in enumerate(sorted(self.queue, key=self._rank), 1):
+                if job['key'] == key:
+                    return i
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            return {'queued': len(self.queue), 'max_queue': self.max_queue,
+                    'running': self.active, 'workers': self.workers, 'sites': dict(self.running)}
 
 class DownloadManager:
-    def __init__(self):
+    def __init__(self, fragment_cap=16, workers=4, max_queue=50, admission='reject',
+                 finished_ttl=3600, finished_keep=100, disk_budget=0, disk_high=0.9, disk_low=0.75):
         # Configurar directorios
         self.base_dir = "downloads"
         self.uploaded_dir = os.path.join(self.base_dir, "uploaded")
         
         if not os.path.exists(self.base_dir): os.makedirs(self.base_dir)
         if not os.path.exists(self.uploaded_dir): os.makedirs(self.uploaded_dir)
+        self.data_dir = "data"
+        if not os.path.exists(self.data_dir): os.makedirs(self.data_dir)
+
+        # Downloader compartido por todas las tareas (pool de YoutubeDL incluido)
+        self.downloader = get_downloader(self.base_dir)
+        # Tope global de fragmentos DASH/HLS en paralelo, repartido entre tareas
+        self.fragment_tuner = FragmentTuner(global_cap=fragment_cap)
+        # Carril de post-procesado (merge, MP3): cada trabajo es un proceso ffmpeg y
+        # estos hilos solo lo esperan, así que hay como mucho un ffmpeg por núcleo.
+        self.postprocess_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count() or 2, thread_name_prefix='ffmpeg')
+        # Presupuestos de bajada/subida compartidos por descargas (yt-dlp) y subidas
+        self.bandwidth = BandwidthScheduler()
+        # Cola de descargas: prioridades, topes por sitio y admisión con la cola llena
+        self.scheduler = JobScheduler(workers=workers, max_queue=max_queue, policy=admission,
+                                      on_drop=lambda task_id, result: self._finish_task(task_id, result))
 
-        # Diccionario para guardar tareas: { 'id': { data... } }
+        # Tareas vivas: { 'id': TaskRecord }. Las terminadas salen de memoria pasado
+        # finished_ttl segundos o cuando hay más de finished_keep (quedan en el historial)
         self.tasks = {}
         self.lock = threading.Lock()
+        self.finished_ttl = finished_ttl
+        self.finished_keep = finished_keep
+        self.evicted = OrderedDict() # { id: TaskSummary } de las últimas tareas sacadas
+
+        # Índice de contenido ya descargado y descargas en curso por contenido
+        self.index = DownloadIndex(os.path.join(self.data_dir, 'download_index.json'))
+        self.inflight = {} # { clave: {'leader': task_id, 'followers': {task_id: Future}} }
+        # Archivos pendientes en downloads/ (para /files)
+        self.files = FileIndex(self.base_dir)
+        # Cuota de disco: total en uso al día y desalojo LRU de lo ya subido
+        self.quota = DiskQuota(self.base_dir, self.uploaded_dir, budget=disk_budget, high=disk_high, low=disk_low,
+                               pinned=self._pinned_files)
+        # file_id de Telegram de lo ya enviado (reenvío por referencia)
+        self.file_ids = FileIdCache(os.path.join(self.data_dir, 'file_ids.json'))
+
+        # Historial de tareas; las descargas a medias se reanudan tras /restart, /update o un reinicio
+        self.store = TaskStore(os.path.join(self.data_dir, 'tasks.db'))
+        self.last_state_save = 0
+        self._load_state()
+
+        # El progreso llega por el bus; las tareas se actualizan como mucho dos veces por segundo
+        self.progress_sub = progress_bus.subscribe(self._on_progress, interval=0.5)
 
     def create_task(self, url):
         """Crea una nueva tarea y devuelve su ID"""
         task_id = str(uuid.uuid4())[:4] # ID corto
         with self.lock:
-            self.tasks[task_id] = {
-                'id': task_id,
-                'url': url,
-                'status': 'starting', 
-                'progress': '0%',
-                'filename': None,
-                'file_path': None,
-                'cancel_flag': False,
-                'last_error': None,
-                'downloader': Downloader(self.base_dir)
-            }
+            self.tasks[task_id] = TaskRecord(task_id, url)
         return task_id
 
     def create_task_from_file(self, filename):
@@ -42,17 +806,11 @@ class DownloadManager:
         
         task_id = str(uuid.uuid4())[:4]
         with self.lock:
-            self.tasks[task_id] = {
-                'id': task_id,
-                'url': 'Local File',
-                'status': 'success', # Listo para subir
-                'progress': '100%',
-                'filename': filename,
-                'file_path': file_path,
-                'cancel_flag': False,
-                'last_error': None,
-                'downloader': None
-            }
+            # Listo para subir
+            self.tasks[task_id] = TaskRecord(task_id, 'Local File', status='success', progress='100%',
+                                             filename=filename, file_path=file_path)
+        # Puede ser nuevo (p.ej. una parte recién cortada)
+        self.quota.add(file_path)
         return task_id
 
     def archive_task_file(self, task_id):
@@ -65,24 +823,48 @@ class DownloadManager:
                 src = task['file_path']
                 filename = os.path.basename(src)
                 dst = os.path.join(self.uploaded_dir, filename)
+
+                # Puede venir del índice y estar ya archivado
+                if os.path.abspath(src) == os.path.abspath(dst):
+                    self.quota.touch(dst)
+                    return True
                 
                 shutil.move(src, dst)
+                self.quota.move(src, dst)
                 
-                # Actualizar la ruta en la tarea por si se consulta después
-                self.tasks[task_id]['file_path'] = dst
+                # Actualizar la ruta en esta tarea y en las que compartían el archivo
+                for t in self.tasks.values():
+                    if t['file_path'] == src:
+                        t['file_path'] = dst
+                self.index.move(src, dst)
                 return True
             except Exception as e:
                 print(f"Error moviendo archivo: {e}")
                 return False
 
-    def get_local_files(self):
-        """Devuelve lista de archivos en 'downloads' (excluyendo 'uploaded')"""
-        try:
-            files = [f for f in os.listdir(self.base_dir) 
-                     if os.path.isfile(os.path.join(self.base_dir, f))]
-            return sorted(files)
-        except:
-            return []
+    def file_id_keys(self, path, with_hash=True):
+        """
+        Claves de la cache de file_id para un archivo: id del video y hash del contenido.
+        Sin with_hash el hash solo se incluye si ya estaba calculado.
+        """
+        keys = [f"vid:{k}" for k in self.index.keys_for(path)]
+        digest = self.file_ids.content_hash(path) if with_hash else self.file_ids.cached_hash(path)
+        if digest:
+            keys.append(f"sha256:{digest}")
+        return keys
+
+    def _pinned_files(self):
+        """Archivos de tareas sin terminar: la cuota no los borra"""
+        with self.lock:
+            return {t['file_path'] for t in self.tasks.values() if t['status'] not in TaskRecord.FINISHED}
+
+    def delete_local_file(self, file_id):
+        """Borra un archivo pendiente de downloads/ por su ID del índice"""
+        entry = self.files.get(file_id)
+        if not entry or not os.path.exists(entry.path): return False
+        self.quota.discard(entry.path)
+        os.remove(entry.path)
+        return True
 
     def clear_uploaded_dir(self):
         """Borra todos los archivos de la carpeta uploaded"""
@@ -91,28 +873,155 @@ class DownloadManager:
             for f in os.listdir(self.uploaded_dir):
                 file_path = os.path.join(self.uploaded_dir, f)
                 if os.path.isfile(file_path):
+                    self.quota.discard(file_path)
                     os.remove(file_path)
                     count += 1
             return True, count
         except Exception as e:
             return False, str(e)
 
+    # --- PERSISTENCIA / REANUDACIÓN ---
+    ACTIVE_STATUSES = TaskRecord.ACTIVE
+
+    def save_state(self, force=False):
+        """
+        Escribe en el historial las tareas en memoria que cambiaron.
+        Sin force, como mucho una escritura por segundo (se llama desde el progreso).
+        """
+        now = time.monotonic()
+        if not force and now - self.last_state_save < 1: return
+        self.last_state_save = now
+
+        with self.lock:
+            tasks = [dict(t) for t in self.tasks.values()]
+        try:
+            self.store.save(tasks)
+        except sqlite3.Error as e:
+            print(f"Error guardando estado: {e}")
+            return
+        self._evict_finished()
+
+    def _evict_finished(self):
+        """Retención: saca de memoria las tareas terminadas viejas o que sobran (ya guardadas)"""
+        now = time.monotonic()
+        dropped = []
+        with self.lock:
+            finished = sorted((t for t in self.tasks.values() if t.finished is not None), key=lambda t: t.finished)
+            extra = len(finished) - self.finished_keep
+            for i, task in enumerate(finished):
+                if i >= extra and now - task.finished < self.finished_ttl: continue
+                del self.tasks[task.id]
+                self.evicted[task.id] = TaskSummary(task.id, task.status, task.filename)
+                dropped.append(task.id)
+            while len(self.evicted) > self.finished_keep:
+                self.evicted.popitem(last=False)
+        self.store.forget(dropped)
+
+    def memory_stats(self):
+        """(tareas en memoria, bytes aproximados que ocupan)"""
+        with self.lock:
+            return len(self.tasks), sum(t.footprint() for t in self.tasks.values())
+
+    @staticmethod
+    def _hydrate(row):
+        """Tarea en memoria a partir de una fila del historial"""
+        fields = {k: row[k] for k in TaskRecord.FIELDS if k in row and k not in ('id', 'url', 'status')}
+        fields.update(single_file=bool(row['single_file']), batch=bool(row['batch']))
+        return TaskRecord(row['id'], row['url'], status=row['status'], **fields)
+
+    def _load_state(self):
+        """Recupera las descargas que quedaron a medias como tareas 'interrupted'"""
+        for row in self.store.by_status(self.ACTIVE_STATUSES + ('interrupted',)):
+            if row['mode'] and not row['batch'] and row['status'] != 'cancelling':
+                task = self._hydrate(dict(row, status='interrupted'))
+                self.tasks[task['id']] = task
+        # Lo que no se puede reanudar (playlists, tareas sin formato elegido) queda como fallido
+        self.store.set_status(self.ACTIVE_STATUSES + ('interrupted',), 'failed_dl', 'Interrupted by restart')
+        self.save_state(force=True)
+
+    def clean_memory(self):
+        """Saca de memoria las tareas terminadas (siguen en el historial)"""
+        self.save_state(force=True)
+        with self.lock:
+            done = [k for k, t in self.tasks.items() if t['status'] not in self.ACTIVE_STATUSES + ('interrupted',)]
+            for k in done:
+                task = self.tasks.pop(k)
+                self.evicted[k] = TaskSummary(k, task.status, task.filename)
+            while len(self.evicted) > self.finished_keep:
+                self.evicted.popitem(last=False)
+        self.store.forget(done)
+        return len(done)
+
+    def get_interrupted_tasks(self):
+        with self.lock:
+            return [t for t in self.tasks.values() if t['status'] == 'interrupted']
+
+    def set_task_priority(self, task_id, priority):
+        """Cambia la prioridad de la tarea (también en el reparto de ancho de banda en curso)"""
+        if priority not in BandwidthScheduler.PRIORITIES: return False
+        with self.lock:
+            if task_id not in self.tasks: return False
+            self.tasks[task_id]['priority'] = priority
+        self.bandwidth.set_priority(task_id, priority)
+        self.scheduler.set_priority(task_id, priority)
+        return True
+
+    def set_task_origin(self, task_id, chat_id, message_id):
+        """Chat y mensaje donde se informa de la tarea (para retomarla tras reiniciar)"""
+        with self.lock:
+            if task_id in self.tasks:
+                self.tasks[task_id]['chat_id'] = chat_id
+                self.tasks[task_id]['message_id'] = message_id
+
     # --- MÉTODOS ESTÁNDAR (Mantener compatibilidad) ---
     def get_task(self, task_id):
         with self.lock:
-            return self.tasks.get(task_id)
+            task = self.tasks.get(task_id)
+        if task: return task
+        # Tareas antiguas (de antes de un reinicio o de /clean) se recuperan del historial
+        row = self.store.get(task_id)
+        if not row: return None
+        with self.lock:
+            return self.tasks.setdefault(task_id, self._hydrate(row))
 
     def get_active_tasks(self):
+        # Consulta por índice de estado; los datos en vivo (progreso) salen de memoria
+        self.save_state(force=True)
+        rows = self.store.by_status(('queued', 'starting', 'downloading', 'processing'))
         with self.lock:
-            return [t for t in self.tasks.values() if t['status'] in ['starting', 'downloading', 'processing']]
+            return [self.tasks.get(r['id'], r) for r in rows]
 
     def cancel_task(self, task_id):
+        """Pide cancelar la tarea; False si no existe o su estado ya no admite cancelarla"""
         with self.lock:
-            if task_id in self.tasks:
-                self.tasks[task_id]['cancel_flag'] = True
-                self.tasks[task_id]['status'] = 'cancelling'
-                return True
-        return False
+            task = self.tasks.get(task_id)
+            if not task: return False
+            idle = task['status'] == 'interrupted'
+            if not task.set_status('cancelled' if idle else 'cancelling'): return False
+            task['cancel_flag'] = True
+        # Si aún estaba en cola (o interrumpida, sin reanudar) no hay descarga que avise: se cancela ya
+        if self.scheduler.cancel(task_id) or idle:
+            self._finish_task(task_id, {'status': 'cancelled'})
+        return True
+
+    def enqueue(self, task_id, fn, mode, quality):
+        """
+        Pone en la cola de descargas fn() (la descarga de la tarea) con la prioridad de la
+        tarea. Devuelve un Future con el resultado, o None si la cola la rechazó.
+        """
+        task = self.get_task(task_id)
+        if not task: return None
+        with self.lock:
+            task.update(mode=mode, quality=quality, status='queued')
+            task['priority'] = task.get('priority') or default_priority(mode, quality)
+        self.save_state(force=True)
+        def start():
+            self.update_status(task_id, 'starting')
+            return fn()
+        future = self.scheduler.submit(task_id, start, task['priority'], site_of(task['url']))
+        if future is None:
+            self.update_status(task_id, 'failed_dl', 'Download queue is full')
+        return future
 
     def delete_task_data(self, task_id):
         with self.lock:
@@ -123,66 +1032,268 @@ class DownloadManager:
             # Asumiremos que delete borra el archivo donde sea que esté apuntando file_path
             if task['file_path'] and os.path.exists(task['file_path']):
                 try:
+                    self.quota.discard(task['file_path'])
                     os.remove(task['file_path'])
                 except: pass
             del self.tasks[task_id]
-            return True
+        self.store.delete(task_id)
+        return True
 
     def reset_task_for_retry(self, task_id):
+        """Deja la tarea lista para reintentar; False si no existe o su estado no lo admite"""
         with self.lock:
-            if task_id in self.tasks:
-                self.tasks[task_id]['status'] = 'starting'
-                self.tasks[task_id]['progress'] = '0%'
-                self.tasks[task_id]['cancel_flag'] = False
-                self.tasks[task_id]['last_error'] = None
-                return True
-        return False
+            task = self.tasks.get(task_id)
+            if not task or not task.set_status('starting'): return False
+            task['progress'] = '0%'
+            task['cancel_flag'] = False
+            task['last_error'] = None
+            return True
 
     def update_status(self, task_id, status, error=None):
         with self.lock:
             if task_id in self.tasks:
                 self.tasks[task_id]['status'] = status
                 if error: self.tasks[task_id]['last_error'] = str(error)
+        self.save_state(force=True)
 
-    def run_download(self, task_id):
+    def run_download(self, task_id, mode='video', quality='best', progress_hook=None, single_file=False):
+        """
+        Descarga el contenido de la tarea.
+        Si ese mismo contenido (extractor, id, formato) ya está en disco se reutiliza, y
+        si ya se envió a Telegram no se descarga: 'path' es None y se reenvía por su file_id.
+        Si ya se está descargando, la tarea se engancha a esa descarga. Si queda
+        merge/conversión, se hace en el carril de ffmpeg y el worker de red queda libre.
+        En esos dos casos se devuelve {'status': 'pending', 'future': ...} y el
+        Future trae el resultado final.
+        """
         task = self.get_task(task_id)
         if not task: return {'status': 'error', 'message': 'Task not found'}
+        downloader = self.downloader
+        with self.lock:
+            task.update(mode=mode, quality=quality, single_file=single_file)
+            task['priority'] = task.get('priority') or default_priority(mode, quality)
+        self.save_state(force=True)
 
-        def check_cancel(): return self.tasks[task_id]['cancel_flag']
+        try:
+            # Gracias a la cache de info, tras el análisis esto no vuelve a la red
+            info = downloader.extract_info(task['url'])
+        except Exception as e:
+            self.update_status(task_id, 'failed_dl', str(e))
+            return {'status': 'error', 'message': str(e)}
 
-        def progress_hook(d):
-            if d['status'] == 'downloading':
-                try:
-                    p = d.get('_percent_str', '0%').replace('%','')
-                    self.tasks[task_id]['progress'] = f"{p}%"
-                    self.tasks[task_id]['status'] = 'downloading'
-                except: pass
-            elif d['status'] == 'finished':
-                self.tasks[task_id]['status'] = 'processing'
+        key = DownloadIndex.make_key(info.get('extractor_key'), info.get('id'), downloader.get_format_key(mode, quality, single_file))
+        with self.lock:
+            task['content_key'] = key
+        existing = self.index.lookup(key)
+        if existing:
+            self.quota.touch(existing)
+            return self._finish_task(task_id, {
+                'status': 'success',
+                'title': info.get('title', 'Unknown'),
+                'path': existing,
+                'from_index': True
+            })
+        # Ya borrado del disco pero enviado antes: se reenvía por su file_id sin descargar
+        if self.file_ids.lookup([f"vid:{key}"]):
+            return self._finish_task(task_id, {
+                'status': 'success',
+                'title': info.get('title', 'Unknown'),
+                'path': None,
+                'by_reference': True
+            })
 
-        try:
-            # Aseguramos que downloader use el dir correcto
-            result = task['downloader'].download(
-                task['url'], 
-                quality='best', 
-                progress_hook=progress_hook,
-                check_cancel=check_cancel
-            )
-            
-            if result['status'] == 'success':
+        with self.lock:
+            entry = self.inflight.get(key)
+            if entry:
+                future = concurrent.futures.Future()
+                entry['followers'][task_id] = future
+                self.tasks[task_id]['status'] = 'downloading'
+                return {'status': 'pending', 'leader': entry['leader'], 'future': future}
+            entry = {'leader': task_id, 'followers': {}}
+            self.inflight[key] = entry
+
+        # Se reserva el tamaño estimado antes de escribir nada (libera archivados si hace falta)
+        if not self.quota.reserve(task_id, estimate_download_size(info, mode, quality)):
+            return self._complete_download(key, entry, task_id, {'status': 'error', 'message': 'Not enough disk space'})
+
+        def attached():
+            # Tareas que esperan esta descarga (llamar con self.lock tomado)
+            return [t for t in [task_id, *entry['followers']] if t in self.tasks]
+
+        def check_cancel():
+            # Solo se corta la descarga si todas las tareas enganchadas la cancelaron
+            with self.lock:
+                return all(self.tasks[t]['cancel_flag'] for t in attached())
+
+        publish = progress_bus.hook(task_id)
+        def hook(d):
+            # Solo números al bus; el formateo lo hace cada consumidor a su ritmo
+            if d['status'] == 'downloading' and d.get('tmpfilename') != task['part_file']:
                 with self.lock:
-                    self.tasks[task_id]['file_path'] = result['path']
-                    self.tasks[task_id]['filename'] = os.path.basename(result['path'])
-                    self.tasks[task_id]['status'] = 'success'
-                return result
-            else:
-                self.update_status(task_id, 'failed_dl', result['message'])
-                return result
+                    task['part_file'] = d.get('tmpfilename')
+            publish(d)
+            if progress_hook:
+                progress_hook(d)
 
+        try:
+            result = downloader.download(
+                task['url'],
+                mode=mode,
+                quality=quality,
+                progress_hook=hook,
+                check_cancel=check_cancel,
+                fragment_tuner=self.fragment_tuner,
+                task_key=task_id,
+                single_file=single_file,
+                defer_postprocessing=True,
+                bandwidth=self.bandwidth,
+                priority=task['priority']
+            )
         except Exception as e:
-            msg = str(e)
-            if msg == "CANCELLED_BY_USER":
+            result = {'status': 'error', 'message': str(e)}
+
+        if result['status'] == 'downloaded':
+            # Los bytes ya están en disco: el merge/MP3 sigue en el carril de ffmpeg
+            future = concurrent.futures.Future()
+            def on_postprocessed(pp_future):
+                try:
+                    future.set_result(self._complete_download(key, entry, task_id, pp_future.result()))
+                except Exception as e:
+                    future.set_exception(e)
+            self.postprocess_executor.submit(downloader.postprocess, result['pending']).add_done_callback(on_postprocessed)
+            return {'status': 'pending', 'leader': task_id, 'future': future}
+
+        return self._complete_download(key, entry, task_id, result)
+
+    def attached_to(self, task_id):
+        """La tarea y las que esperan su misma descarga (reciben sus eventos de progreso)"""
+        with self.lock:
+            return self._attached_to(task_id)
+
+    def _attached_to(self, task_id):
+        for entry in self.inflight.values():
+            if entry['leader'] == task_id:
+                return [task_id, *entry['followers']]
+        return [task_id]
+
+    def _on_progress(self, events):
+        """Consumidor del bus: vuelca el progreso en la tarea y en las enganchadas a ella"""
+        with self.lock:
+            for event in events:
+                if event.phase not in ('downloading', 'processing'): continue
+                fraction = event.fraction
+                for t in self._attached_to(event.key):
+                    task = self.tasks.get(t)
+                    if not task: continue
+                    task['status'] = event.phase
+                    if fraction is not None:
+                        task['progress'] = f"{fraction * 100:.1f}%"
+                    if event.phase == 'downloading':
+                        task.update(downloaded_bytes=event.downloaded or 0, total_bytes=event.total,
+                                    speed=event.speed, eta=event.eta)
+        self.save_state()
+
+    def _complete_download(self, key, entry, task_id, result):
+        """Cierra una descarga en curso: índice, cuota, tareas enganchadas y la propia tarea"""
+        if result['status'] == 'success':
+            self.index.record(key, result['path'])
+        self.quota.release(task_id, result['path'] if result['status'] == 'success' else None)
+
+        with self.lock:
+            self.inflight.pop(key, None)
+            followers = dict(entry['followers'])
+        for follower_id, future in followers.items():
+            future.set_result(self._finish_task(follower_id, result))
+        return self._finish_task(task_id, result)
+
+    def run_batch(self, task_id, mode='video', quality='best', executor=None, parallel=2):
+        """
+        Generador para tareas de playlist/canal: expande la playlist perezosamente,
+        reparte las entradas (en `executor` o, por defecto, en la cola de descargas)
+        con como mucho `parallel` a la vez y devuelve (task_id, resultado) de cada
+        entrada en cuanto termina. Al cancelar el lote se cancelan las entradas en curso
+        y no se devuelve nada más.
+        """
+        batch = self.get_task(task_id)
+        if not batch: return
+
+        with self.lock:
+            batch['batch'] = True
+        entries = self.downloader.iter_playlist(batch['url'])
+        pending = {} # { Future: task_id de la entrada }
+        exhausted = False
+        started = finished = 0
+        self.update_status(task_id, 'downloading')
+
+        try:
+            while True:
+                if batch['cancel_flag']:
+                    # Las entradas en curso cortan su descarga con su propio cancel_flag
+                    for child_id in pending.values():
+                        self.cancel_task(child_id)
+                    return
+
+                # Solo pedimos más entradas cuando hay hueco: la playlist se expande al ritmo de las descargas
+                while not exhausted and len(pending) < parallel:
+                    try:
+                        entry = next(entries, None)
+                    except Exception as e:
+                        self.update_status(task_id, 'downloading', e)
+                        entry = None
+                    if entry is None:
+                        exhausted = True
+                        break
+                    child_id = self.create_task(entry['url'])
+                    if executor:
+                        future = executor.submit(self.run_download, child_id, mode, quality)
+                    else:
+                        future = self.enqueue(child_id, lambda c=child_id: self.run_download(c, mode, quality), mode, quality)
+                    if future is None:
+                        future = concurrent.futures.Future()
+                        future.set_result({'status': 'error', 'message': 'Download queue is full'})
+                    pending[future] = child_id
+                    started += 1
+
+                if not pending:
+                    break
+
+                # Con timeout: un /cancel del lote no espera a que termine alguna entrada
+                done, _ = concurrent.futures.wait(pending, timeout=0.5, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if batch['cancel_flag']: break
+                    child_id = pending.pop(future)
+                    result = future.result()
+                    if result['status'] == 'pending':
+                        # Otra tarea ya baja este video, o falta el post-procesado: esperamos al Future
+                        pending[result['future']] = child_id
+                        continue
+                    finished += 1
+                    with self.lock:
+                        batch['progress'] = f"{finished}/{started}"
+                    yield child_id, result
+        finally:
+            entries.close()
+            if batch['cancel_flag']:
                 self.update_status(task_id, 'cancelled')
-                return {'status': 'cancelled', 'message': 'Cancelado por usuario'}
-            self.update_status(task_id, 'failed_dl', msg)
-            return {'status': 'error', 'message': msg}
+            else:
+                self.update_status(task_id, 'failed_dl' if batch['last_error'] else 'completed')
+
+    def _finish_task(self, task_id, result):
+        """Aplica el resultado de una descarga a una tarea concreta y lo devuelve"""
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if not task:
+                return {'status': 'error', 'message': 'Task not found'}
+            if task['cancel_flag']:
+                task['status'] = 'cancelled'
+                result = {'status': 'cancelled', 'message': 'Cancelado por usuario'}
+            elif result['status'] == 'success':
+                task['file_path'] = result['path']
+                task['filename'] = os.path.basename(result['path']) if result['path'] else result.get('title')
+                task['status'] = 'success'
+            else:
+                task['status'] = 'failed_dl'
+                task['last_error'] = str(result.get('message'))
+        progress_bus.publish(task_id, 'done' if result['status'] == 'success' else 'error')
+        self.save_state(force=True)
+        return result
@@ -1,5 +1,5 @@
 import flet as ft
-from src.core import Downloader
+from src.core import get_downloader, progress_bus
 import threading
 import os
 import subprocess
@@ -12,7 +12,7 @@ def main(page: ft.Page):
     page.window_height = 700
     page.padding = 20
 
-    downloader = Downloader()
+    downloader = get_downloader()
 
     # --- UI Components: Download Tab ---
     url_input = ft.TextField(label="Pegar Link (YouTube, X.com...)", width=400, prefix_icon=ft.icons.LINK)
@@ -59,18 +59,16 @@ def main(page: ft.Page):
 
     # --- Logic ---
 
-    def progress_hook(d):
-        if d['status'] == 'downloading':
-            try:
-                # Calcular porcentaje 0.0 a 1.0
-                p = d.get('_percent_str', '0%').replace('%','')
-                progress = float(p) / 100
-                progress_bar.value = progress
-                progress_text.value = f"Descargando... {p}%"
-                page.update()
-            except:
-                pass
-        elif d['status'] == 'finished':
+    def on_progress(events):
+        # Consumidor del bus: como mucho ~4 refrescos por segundo
+        event = events[-1]
+        if event.phase == 'downloading':
+            fraction = event.fraction
+            if fraction is None: return
+            progress_bar.value = fraction
+            progress_text.value = f"Descargando... {fraction * 100:.1f}%"
+            page.update()
+        elif event.phase == 'processing':
             progress_bar.value = 1
             progress_text.value = "Procesando archivo..."
             page.update()
@@ -96,7 +94,12 @@ def main(page: ft.Page):
         quality = '720' if q_val == 'audio' else q_val
 
         def task():
-            result = downloader.download(url, mode=mode, quality=quality, progress_hook=progress_hook)
+            key = f"ui-{id(page)}"
+            sub = progress_bus.subscribe(on_progress, interval=0.25, keys={key})
+            try:
+                result = downloader.download(url, mode=mode, quality=quality, progress_hook=progress_bus.hook(key))
+            finally:
+                progress_bus.unsubscribe(sub)
             
             if result['status'] == 'success':
                 status_text.value = "¡Descarga Exitosa!"